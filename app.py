@@ -1,11 +1,57 @@
 import os
-from flask import Flask, request, jsonify
+import atexit
+from flask import Flask, Response, current_app, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 import pymysql
 import requests
+import requests.adapters
 import math
+import json
+import base64
+import hashlib
+import hmac
+import time
+import threading
+import collections
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import heapq
+import re
+import queue
+import sqlite3
+import bisect
+import logging
+import sys
+import socket
+from urllib.parse import urlparse
+import decimal
+import gzip
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date, parse_accept_header
 from dotenv import load_dotenv, dotenv_values
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+load_dotenv()
+
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("events")
+logger.setLevel(os.getenv("log_level", "INFO").upper())
+
 def get_distance(lat1, long1, lat2, long2):
     # this was pulled from here: https://stackoverflow.com/questions/4913349/haversine-formula-in-python-bearing-and-distance-between-two-gps-points 
     # converting degrees to radians
@@ -22,23 +68,3067 @@ def get_distance(lat1, long1, lat2, long2):
     c = 2 * math.asin(math.sqrt(a))
     return r * c
 
-def hashC(coord):
-    return int(coord * 10)
+def batch_distances(lat, long, lats, longs, radians=False):
+    # same haversine as get_distance, from one origin to many points at once.
+    # With radians=True the points (not the origin) are already in radians
+    r = 3956 # earth radius
+    if np is not None:
+        lat1 = np.radians(lat)
+        long1 = np.radians(long)
+        lat2 = np.asarray(lats, dtype=float)
+        long2 = np.asarray(longs, dtype=float)
+        if not radians:
+            lat2 = np.radians(lat2)
+            long2 = np.radians(long2)
+        a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2)**2
+        return r * 2 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+    lat1 = math.radians(lat)
+    long1 = math.radians(long)
+    cos_lat1 = math.cos(lat1)
+    sin, cos, asin, sqrt = math.sin, math.cos, math.asin, math.sqrt
+    if not radians:
+        lats = map(math.radians, lats)
+        longs = map(math.radians, longs)
+    out = []
+    for lat2, long2 in zip(lats, longs):
+        a = sin((lat2 - lat1) / 2)**2 + cos_lat1 * cos(lat2) * sin((long2 - long1) / 2)**2
+        out.append(r * 2 * asin(sqrt(min(a, 1.0))))
+    return out
+
+def nearest(lat, long, lats, longs, k=None, radius=None, radians=False):
+    # indices of the points ordered nearest first, optionally only the k
+    # closest and/or only the ones within radius miles, plus all distances
+    dists = batch_distances(lat, long, lats, longs, radians)
+    n = len(dists)
+    if np is not None:
+        idx = np.arange(n)
+        if radius is not None:
+            idx = idx[dists[idx] <= radius]
+        if k is not None and k < len(idx):
+            idx = idx[np.argpartition(dists[idx], k)[:k]]
+        order = idx[np.argsort(dists[idx], kind="stable")]
+        return order.tolist(), dists.tolist()
+
+    idx = range(n)
+    if radius is not None:
+        idx = [i for i in idx if dists[i] <= radius]
+    if k is not None and k < len(idx):
+        order = heapq.nsmallest(k, idx, key=dists.__getitem__)
+    else:
+        order = sorted(idx, key=dists.__getitem__)
+    return order, dists
+
+def hashC(coord):
+    return int(coord * 10)
+
+class Histogram:
+    # latency histogram in milliseconds with fixed buckets, percentiles are
+    # read off the bucket bounds
+    BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf"))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+
+    def observe(self, ms, rows=0):
+        self.counts[bisect.bisect_left(self.BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        self.rows += rows
+
+    def percentile(self, p):
+        wanted = p * self.count
+        seen = 0
+        for bound, n in zip(self.BUCKETS, self.counts):
+            seen += n
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "avgMs": round(self.total / self.count, 3) if self.count else 0.0,
+            "maxMs": round(self.max, 3),
+            "p50Ms": round(self.percentile(0.50), 3),
+            "p95Ms": round(self.percentile(0.95), 3),
+            "p99Ms": round(self.percentile(0.99), 3),
+        }
+
+
+class Metrics:
+    # per-route, per-SQL-statement, DB acquire and geocoder timings
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = collections.defaultdict(dict)
+        self.profiles = collections.deque(maxlen=20)
+
+    def observe(self, kind, name, seconds, rows=0):
+        with self._lock:
+            series = self._series[kind]
+            hist = series.get(name)
+            if hist is None:
+                hist = series[name] = Histogram()
+            hist.observe(seconds * 1000, rows)
+
+    def snapshot(self):
+        with self._lock:
+            out = {}
+            for kind, series in self._series.items():
+                out[kind] = {}
+                for name, hist in series.items():
+                    summary = hist.summary()
+                    if kind == "queries":
+                        summary["rows"] = hist.rows
+                    out[kind][name] = summary
+            return out
+
+
+metrics = Metrics()
+
+
+def statement_name(query):
+    # groups executions of the same statement whatever the IN list length
+    query = re.sub(r"\s+", " ", query).strip()
+    query = re.sub(r"\(\s*%s(\s*,\s*%s)*\s*\)", "(...)", query)
+    return query[:160]
+
+
+class InstrumentedCursor:
+    # times every statement run through the cursor and counts its rows
+    def __init__(self, raw):
+        self._raw = raw
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def _timed(self, run, query, args, name=None):
+        start = time.perf_counter()
+        try:
+            return run(query, args)
+        finally:
+            # unbuffered cursors don't know their row count up front (pymysql
+            # reports 2**64 - 1 for them)
+            rows = 0
+            if not isinstance(self._raw, pymysql.cursors.SSCursor) and self._raw.rowcount and self._raw.rowcount > 0:
+                rows = self._raw.rowcount
+            metrics.observe("queries", name or statement_name(query), time.perf_counter() - start, rows)
+
+    def execute(self, query, args=None, name=None):
+        # name files the timing under a fixed label, for statements built
+        # with their values inlined
+        return self._timed(self._raw.execute, query, args, name)
+
+    def executemany(self, query, args):
+        return self._timed(self._raw.executemany, query, args)
+
+
+class SamplingProfiler:
+    # samples one thread's stack every interval seconds while running, for
+    # a cheap picture of where a single slow request spends its time
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < 12:
+                code = frame.f_code
+                stack.append("%s:%d %s" % (os.path.basename(code.co_filename), frame.f_lineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.samples[" < ".join(stack)] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, top=10):
+        self._stop.set()
+        self._thread.join()
+        return {"samples": sum(self.samples.values()), "top": self.samples.most_common(top)}
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    # wraps a pymysql connection so the routes can keep calling conn.close()
+    # in their finally blocks, which hands the connection back to the pool
+    def __init__(self, pool, entry):
+        self._pool = pool
+        self._entry = entry
+
+    def __getattr__(self, name):
+        return getattr(self._entry.raw, name)
+
+    def cursor(self, cursor=None):
+        return InstrumentedCursor(self._entry.raw.cursor(cursor))
+
+    def close(self):
+        if self._entry is not None:
+            entry, self._entry = self._entry, None
+            self._pool.release(entry)
+
+
+class _PoolEntry:
+    __slots__ = ("raw", "created", "last_used")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+
+class ConnectionPool:
+    # bounded, thread safe pool of pymysql connections
+    def __init__(self, connect, min_size=1, max_size=10, timeout=5.0,
+                 idle_timeout=300.0, max_lifetime=3600.0, ping_interval=1.0):
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+
+        self._cond = threading.Condition()
+        self._idle = collections.deque()
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+
+        self._borrows = 0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+        for _ in range(min(min_size, self.max_size)):
+            try:
+                self._idle.append(self._open())
+                self._size += 1
+            except Exception as e:
+                # the database may not be up yet, connections get made on demand
+                logger.warning("Could not pre-fill connection pool: %s", e)
+                break
+
+    def _open(self):
+        entry = _PoolEntry(self._connect())
+        with self._cond:
+            self._created += 1
+        return entry
+
+    def _discard(self, entry):
+        try:
+            entry.raw.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._discarded += 1
+
+    def _expired(self, entry, now):
+        return self.max_lifetime and now - entry.created > self.max_lifetime
+
+    def _healthy(self, entry, now):
+        if now - entry.last_used < self.ping_interval:
+            return True
+        try:
+            entry.raw.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def _evict_idle(self, now):
+        # called with the lock held, drops connections that sat idle too long
+        # (oldest first) while keeping min_size around
+        evicted = []
+        while self._idle and self._size > self.min_size:
+            entry = self._idle[0]
+            if not (self.idle_timeout and now - entry.last_used > self.idle_timeout):
+                break
+            self._idle.popleft()
+            self._size -= 1
+            evicted.append(entry)
+        return evicted
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            entry = None
+            reserved = False
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout("Timed out waiting for a database connection")
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+                stale = self._evict_idle(time.monotonic())
+                if self._idle:
+                    # most recently used first, so the cold ones age out
+                    entry = self._idle.pop()
+                else:
+                    self._size += 1
+                    reserved = True
+                self._in_use += 1
+
+            for old in stale:
+                self._discard(old)
+
+            if reserved:
+                try:
+                    entry = self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._in_use -= 1
+                        self._cond.notify()
+                    raise
+            else:
+                now = time.monotonic()
+                if self._expired(entry, now) or not self._healthy(entry, now):
+                    with self._cond:
+                        self._size -= 1
+                        self._in_use -= 1
+                        self._cond.notify()
+                    self._discard(entry)
+                    continue
+
+            waited = time.monotonic() - start
+            with self._cond:
+                self._borrows += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            return PooledConnection(self, entry)
+
+    def release(self, entry):
+        now = time.monotonic()
+        # anything the route left uncommitted is thrown away, same as closing
+        # a fresh connection would have done
+        try:
+            entry.raw.rollback()
+            healthy = True
+        except Exception:
+            healthy = False
+
+        with self._cond:
+            self._in_use -= 1
+            if healthy and not self._expired(entry, now):
+                entry.last_used = now
+                self._idle.append(entry)
+                stale = self._evict_idle(now)
+            else:
+                self._size -= 1
+                stale = [entry]
+            self._cond.notify()
+
+        for entry in stale:
+            self._discard(entry)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "inUse": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "maxSize": self.max_size,
+                "minSize": self.min_size,
+                "borrows": self._borrows,
+                "timeouts": self._timeouts,
+                "created": self._created,
+                "discarded": self._discarded,
+                "avgWaitMs": round(self._wait_total / self._borrows * 1000, 3) if self._borrows else 0.0,
+                "maxWaitMs": round(self._wait_max * 1000, 3),
+            }
+
+    def close(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for entry in idle:
+            self._discard(entry)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _open_connection():
+    # the pymysql connector
+    return pymysql.connect(
+        host=os.getenv("db_host"),
+        user=os.getenv("db_user"),
+        password=os.getenv("db_password"),
+        database=os.getenv("db_name"),
+        cursorclass=pymysql.cursors.DictCursor
+    )
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    _open_connection,
+                    min_size=int(os.getenv("db_pool_min", 1)),
+                    max_size=int(os.getenv("db_pool_max", 10)),
+                    timeout=float(os.getenv("db_pool_timeout", 5)),
+                    idle_timeout=float(os.getenv("db_pool_idle", 300)),
+                    max_lifetime=float(os.getenv("db_pool_lifetime", 3600)),
+                    ping_interval=float(os.getenv("db_pool_ping", 1)),
+                )
+    return _pool
+
+
+def connect_to_db():
+    # borrows a connection from the pool, conn.close() gives it back
+    start = time.perf_counter()
+    try:
+        return get_pool().acquire()
+    finally:
+        metrics.observe("dbAcquire", "pool", time.perf_counter() - start)
+
+
+# default search radius in miles for users that never set one
+DEFAULT_DIST = 25
+
+
+def is_upcoming(event):
+    date = event.get("date")
+    if isinstance(date, datetime.datetime):
+        return date >= datetime.datetime.now()
+    if isinstance(date, datetime.date):
+        return date >= datetime.date.today()
+    return True
+
+
+def expires_at(event):
+    # the moment is_upcoming turns False for event, None if it never does
+    date = event.get("date")
+    if isinstance(date, datetime.datetime):
+        return date
+    if isinstance(date, datetime.date):
+        return datetime.datetime.combine(date + datetime.timedelta(days=1), datetime.time())
+    return None
+
+
+def cell_of(event):
+    return (hashC(float(event["lat"])), hashC(float(event["long"])))
+
+
+def cell_ranges(lat, long, radius):
+    # the hashC cells a circle of radius miles around (lat, long) can touch,
+    # as a lat cell range plus one or two long cell ranges (two when the
+    # circle wraps around the antimeridian)
+    span = math.degrees(radius / 3956)
+    lo_lat = max(lat - span, -90.0)
+    hi_lat = min(lat + span, 90.0)
+    lat_cells = range(hashC(lo_lat), hashC(hi_lat) + 1)
+
+    # longitude degrees shrink towards the poles, so size the box using the
+    # edge closest to one
+    widest = max(abs(lo_lat), abs(hi_lat))
+    if widest >= 89.9:
+        return lat_cells, [range(hashC(-180.0), hashC(180.0) + 1)]
+    long_span = span / math.cos(math.radians(widest))
+    if long_span >= 180:
+        return lat_cells, [range(hashC(-180.0), hashC(180.0) + 1)]
+
+    lo_long = long - long_span
+    hi_long = long + long_span
+    if lo_long < -180:
+        return lat_cells, [range(hashC(lo_long + 360), hashC(180.0) + 1),
+                           range(hashC(-180.0), hashC(hi_long) + 1)]
+    if hi_long > 180:
+        return lat_cells, [range(hashC(lo_long), hashC(180.0) + 1),
+                           range(hashC(-180.0), hashC(hi_long - 360) + 1)]
+    return lat_cells, [range(hashC(lo_long), hashC(hi_long) + 1)]
+
+
+def tokenize(text):
+    # lowercase words of a tags/prefs string, so "art" no longer matches "party"
+    return set(re.findall(r"[a-z0-9]+", (text or "").lower()))
+
+
+@functools.lru_cache(maxsize=4096)
+def tag_tokens(tags):
+    # tokenize() as a shared frozenset, most events repeat a few tag strings
+    return frozenset(tokenize(tags))
+
+
+def json_default(o):
+    # what flask's default JSON provider does with the types pymysql returns
+    if isinstance(o, datetime.date):
+        return http_date(o)
+    if isinstance(o, decimal.Decimal):
+        return str(o)
+    raise TypeError("Object of type %s is not JSON serializable" % type(o).__name__)
+
+
+def stdlib_dumps(obj, default=json_default):
+    # what jsonify used to produce
+    return json.dumps(obj, default=default, sort_keys=True, separators=(",", ":"))
+
+
+ORJSON_OPTIONS = 0
+if orjson is not None:
+    # dates still go through json_default so they keep their HTTP date format
+    ORJSON_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def orjson_default(o):
+    # orjson 3.9+ can splice stored JSON in as a Fragment
+    if isinstance(o, EventRecord) and hasattr(orjson, "Fragment"):
+        return orjson.Fragment(o.json)
+    return json_default(o)
+
+
+def orjson_dumps(obj, default=orjson_default):
+    return orjson.dumps(obj, default=default, option=ORJSON_OPTIONS).decode()
+
+
+# json_backend=stdlib turns orjson off even when it is installed
+if orjson is not None and os.getenv("json_backend", "auto") != "stdlib":
+    dumps = orjson_dumps
+else:
+    dumps = stdlib_dumps
+
+
+class EventRecord:
+    # compact, read-only stand-in for an events row in the feed, the event
+    # grid and the feed cache. It keeps only what those compute on, the tag
+    # tokens and coordinates in radians worked out once, plus the row's JSON
+    # so responses can splice it in without building dicts again
+    __slots__ = ("UEID", "eventHost", "date", "isPrivate", "lat", "long",
+                 "radLat", "radLong", "tokens", "json")
+    COLUMNS = frozenset(("UEID", "eventHost", "date", "isPrivate", "lat", "long"))
+
+    def __init__(self, row):
+        self.UEID = row["UEID"]
+        self.eventHost = row.get("eventHost")
+        self.date = row.get("date")
+        self.isPrivate = bool(row.get("isPrivate"))
+        self.lat = float(row["lat"]) if row.get("lat") is not None else None
+        self.long = float(row["long"]) if row.get("long") is not None else None
+        self.radLat = math.radians(self.lat) if self.lat is not None else None
+        self.radLong = math.radians(self.long) if self.long is not None else None
+        self.tokens = tag_tokens(row.get("tags"))
+        self.json = dumps(row)
+
+    # dict style reads so code written against DictCursor rows keeps working
+    def __getitem__(self, key):
+        if key not in self.COLUMNS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.COLUMNS else default
+
+
+# stands in for an EventRecord during dumps(), the NUL and the per-process
+# nonce keep it from matching anything a client could have stored
+RECORD_MARK = "\x00record:" + os.urandom(6).hex() + ":"
+RECORD_MARK_RE = re.compile(re.escape(json.dumps(RECORD_MARK)[:-1]) + r'(\d+)"')
+
+
+def encode_json(obj):
+    # dumps() that writes EventRecords out as their stored JSON. Without
+    # orjson's Fragment each record is dumped as a marker string, and the
+    # markers are swapped for the records' JSON afterwards, so the payload
+    # still goes through dumps() in one call
+    if dumps is orjson_dumps and hasattr(orjson, "Fragment"):
+        return dumps(obj)
+    if isinstance(obj, EventRecord):
+        return obj.json
+    records = []
+
+    def mark(o):
+        if isinstance(o, EventRecord):
+            records.append(o.json)
+            return RECORD_MARK + str(len(records) - 1)
+        return json_default(o)
+
+    out = dumps(obj, default=mark)
+    if not records:
+        return out
+    return RECORD_MARK_RE.sub(lambda m: records[int(m.group(1))], out)
+
+
+class EventJSONProvider(DefaultJSONProvider):
+    # app.json for every route: the dumps backend picked above and
+    # EventRecords written out as stored
+    def dumps(self, obj, **kwargs):
+        return encode_json(obj)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+
+COMPRESS_MIN_BYTES = int(os.getenv("compress_min_bytes", 1024))
+GZIP_LEVEL = int(os.getenv("compress_gzip_level", 6))
+BROTLI_QUALITY = int(os.getenv("compress_br_quality", 4))
+
+
+def pick_encoding(accept_encoding):
+    # br when both sides have it, then gzip, from an Accept-Encoding value
+    accept = parse_accept_header(accept_encoding or "")
+    if brotli is not None and accept.quality("br") > 0:
+        return "br"
+    if accept.quality("gzip") > 0:
+        return "gzip"
+    return None
+
+
+def compress_body(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+class TagIndex:
+    # inverted index from tag token to the UEIDs carrying it, not thread
+    # safe on its own, EventGrid guards it with its lock
+    def __init__(self):
+        self._postings = {}
+        self._tokens = {}
+
+    def add(self, ueid, tokens):
+        self.remove(ueid)
+        self._tokens[ueid] = tokens
+        for token in tokens:
+            self._postings.setdefault(token, set()).add(ueid)
+
+    def remove(self, ueid):
+        for token in self._tokens.pop(ueid, ()):
+            ueids = self._postings[token]
+            ueids.discard(ueid)
+            if not ueids:
+                del self._postings[token]
+
+    def match_counts(self, tokens, ueids):
+        # how many of tokens each of ueids is tagged with, leaving out the
+        # ones that match none. Walks the postings or the candidates,
+        # whichever is smaller
+        postings = [self._postings[t] for t in tokens if t in self._postings]
+        counts = {}
+        if sum(len(p) for p in postings) <= len(ueids):
+            wanted = ueids if isinstance(ueids, (set, frozenset, dict)) else set(ueids)
+            for p in postings:
+                for ueid in p:
+                    if ueid in wanted:
+                        counts[ueid] = counts.get(ueid, 0) + 1
+        else:
+            for ueid in ueids:
+                n = len(tokens & self._tokens.get(ueid, frozenset()))
+                if n:
+                    counts[ueid] = n
+        return counts
+
+    def clear(self):
+        self._postings = {}
+        self._tokens = {}
+
+
+class LoadedIndex:
+    # base for in-process copies of DB state. The first caller of
+    # ensure_loaded builds it, after that it is rebuilt in the background
+    # every self.refresh seconds. Subclasses make every change through
+    # _apply so changes landing mid-rebuild are replayed on the fresh copy
+    name = "index"
+
+    def __init__(self, refresh=300):
+        self.refresh = refresh
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()
+        self._loaded_at = None
+        self._pending = None
+
+    def _rebuild(self, data):
+        raise NotImplementedError
+
+    def _apply(self, op, *args):
+        with self._lock:
+            op(*args)
+            if self._pending is not None:
+                self._pending.append((op, args))
+
+    def reload(self, loader):
+        with self._lock:
+            self._pending = []
+        try:
+            data = loader()
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            self._rebuild(data)
+            for op, args in self._pending:
+                op(*args)
+            self._pending = None
+            self._loaded_at = time.monotonic()
+
+    def _refresh(self, loader):
+        try:
+            self.reload(loader)
+        except Exception as e:
+            logger.exception("Refreshing the %s failed: %s", self.name, e)
+        finally:
+            self._load_lock.release()
+
+    def ensure_loaded(self, loader):
+        if self._loaded_at is None:
+            with self._load_lock:
+                if self._loaded_at is None:
+                    self.reload(loader)
+        elif time.monotonic() - self._loaded_at > self.refresh and self._load_lock.acquire(blocking=False):
+            threading.Thread(target=self._refresh, args=(loader,), daemon=True).start()
+
+
+class EventGrid(LoadedIndex):
+    # in-process index of upcoming public events (as EventRecords), bucketed
+    # into the same 0.1 degree cells that hashC puts in the events table.
+    # Expiry times sit in a heap so queries only have to prune once the
+    # earliest one passes
+    name = "event index"
+
+    def __init__(self, refresh=300):
+        super().__init__(refresh)
+        self._cells = {}
+        self._where = {}
+        self._tags = TagIndex()
+        self._expiry = []
+
+    def _add(self, event):
+        self._remove(event["UEID"])
+        if event.get("isPrivate") or not is_upcoming(event):
+            return
+        if event.get("lat") is None or event.get("long") is None:
+            return
+        cell = cell_of(event)
+        self._cells.setdefault(cell, {})[event["UEID"]] = event
+        self._where[event["UEID"]] = cell
+        self._tags.add(event.UEID, event.tokens)
+        expiry = expires_at(event)
+        if expiry is not None:
+            heapq.heappush(self._expiry, (expiry, event["UEID"]))
+
+    def _remove(self, ueid):
+        cell = self._where.pop(ueid, None)
+        if cell is None:
+            return
+        self._tags.remove(ueid)
+        events = self._cells[cell]
+        events.pop(ueid, None)
+        if not events:
+            del self._cells[cell]
+
+    def _rebuild(self, rows):
+        self._cells = {}
+        self._where = {}
+        self._tags.clear()
+        self._expiry = []
+        for row in rows:
+            self._add(row)
+
+    def _prune(self, now):
+        # heap entries of removed or re-added events are skipped lazily
+        while self._expiry and self._expiry[0][0] < now:
+            expiry, ueid = heapq.heappop(self._expiry)
+            cell = self._where.get(ueid)
+            if cell is not None and expires_at(self._cells[cell][ueid]) == expiry:
+                self._remove(ueid)
+
+    def add(self, event):
+        self._apply(self._add, event)
+
+    def remove(self, ueid):
+        self._apply(self._remove, ueid)
+
+    def get(self, ueid):
+        with self._lock:
+            cell = self._where.get(ueid)
+            return self._cells[cell][ueid] if cell is not None else None
+
+    def next_expiry(self):
+        with self._lock:
+            return self._expiry[0][0] if self._expiry else None
+
+    def query(self, lat, long, radius):
+        lat_cells, long_ranges = cell_ranges(lat, long, radius)
+        found = []
+        with self._lock:
+            now = datetime.datetime.now()
+            if self._expiry and self._expiry[0][0] < now:
+                self._apply(self._prune, now)
+            wanted = len(lat_cells) * sum(len(r) for r in long_ranges)
+            if wanted <= len(self._cells):
+                buckets = [self._cells.get((a, b)) for a in lat_cells for r in long_ranges for b in r]
+            else:
+                # large radius over a sparse index, cheaper to walk what exists
+                buckets = [events for (a, b), events in self._cells.items()
+                           if a in lat_cells and any(b in r for r in long_ranges)]
+            for events in buckets:
+                if events:
+                    found.extend(events.values())
+
+        # nearest first
+        order, _ = nearest(lat, long,
+                           [event.radLat for event in found],
+                           [event.radLong for event in found],
+                           radius=radius, radians=True)
+        return [found[i] for i in order]
+
+    def rank_by_tags(self, events, tokens):
+        # events sharing at least one of tokens, most shared tags first,
+        # keeping the incoming order among ties
+        with self._lock:
+            counts = self._tags.match_counts(tokens, [event["UEID"] for event in events])
+        matching = [event for event in events if event["UEID"] in counts]
+        matching.sort(key=lambda event: -counts[event["UEID"]])
+        return matching
+
+    def __len__(self):
+        with self._lock:
+            return len(self._where)
+
+
+PUBLIC_EVENTS_Q = """
+    SELECT e.*, u.userName AS hostName
+    FROM events e
+    JOIN users u ON e.eventHost = u.UUID
+    WHERE e.isPrivate = FALSE AND e.date >= NOW()
+"""
+
+EVENTS_BY_ID_Q = """
+    SELECT e.*, u.userName AS hostName
+    FROM events e
+    JOIN users u ON e.eventHost = u.UUID
+    WHERE e.UEID IN ({})
+"""
+
+
+# one event with its host name, live signup count and remaining spots
+EVENT_DETAIL_Q = """
+    SELECT e.*, u.userName AS hostName, COALESCE(c.signUps, 0) AS signUps
+    FROM events e
+    LEFT JOIN users u ON e.eventHost = u.UUID
+    LEFT JOIN signUpCounts c ON c.UEID = e.UEID
+    WHERE e.UEID = %s
+"""
+
+# everything a user is hosting or attending, in one pass
+USER_EVENTS_Q = """
+    SELECT e.*, u.userName AS hostName, COALESCE(c.signUps, 0) AS signUps,
+        e.eventHost = %s AS hosting
+    FROM events e
+    JOIN users u ON e.eventHost = u.UUID
+    LEFT JOIN signUpCounts c ON c.UEID = e.UEID
+    WHERE e.date >= NOW() AND (
+        e.eventHost = %s
+        OR e.UEID IN (SELECT UEID FROM signedUp WHERE UUID = %s)
+    )
+"""
+
+# keyset condition on USER_EVENTS_Q's (hosting DESC, date, UEID) order
+USER_EVENTS_AFTER_Q = """
+    AND (
+        (e.eventHost = %s) < %s
+        OR ((e.eventHost = %s) = %s AND (e.date > %s OR (e.date = %s AND e.UEID > %s)))
+    )
+"""
+
+USER_EVENTS_ORDER_Q = " ORDER BY hosting DESC, e.date, e.UEID"
+
+
+# bumps the counter only while there is room under the event's own cap,
+# a cap of 0 (or none) means unlimited
+TAKE_SPOT_Q = """
+    UPDATE signUpCounts c
+    JOIN events e ON e.UEID = c.UEID
+    SET c.signUps = c.signUps + 1
+    WHERE c.UEID = %s AND (e.cap IS NULL OR e.cap <= 0 OR c.signUps < e.cap)
+"""
+
+SPOTS_Q = """
+    SELECT e.cap, c.signUps
+    FROM events e
+    LEFT JOIN signUpCounts c ON c.UEID = e.UEID
+    WHERE e.UEID = %s
+"""
+
+CHECK_SIGNED_UP_Q = "SELECT 1 FROM signedUp WHERE UUID = %s AND UEID = %s"
+
+
+# largest list the batch routes accept in one request
+BATCH_MAX = int(os.getenv("batch_max_items", 500))
+
+
+def with_remaining(event):
+    # cap of 0 (or none) means the event has no limit
+    cap = event.get("cap")
+    event["remaining"] = max(int(cap) - event["signUps"], 0) if cap else None
+    return event
+
+
+# largest page the list routes hand out when a limit is asked for
+PAGE_MAX = int(os.getenv("page_max", 200))
+
+
+class BadCursor(Exception):
+    pass
+
+
+def encode_cursor(*values):
+    # opaque keyset cursor handed back as "next" and taken back as "after"
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise BadCursor("Invalid cursor")
+
+
+def page_args():
+    # (limit, decoded after cursor), limit is None when the caller wants
+    # everything in one go like before
+    limit = request.args.get("limit", type=int)
+    if limit is not None:
+        limit = max(1, min(limit, PAGE_MAX))
+    after = request.args.get("after")
+    return limit, decode_cursor(after) if after else None
+
+
+def wants_stream():
+    return request.args.get("stream") in ("1", "true")
+
+
+def stream_json(query, params, split, keys, extra=None, limit=None, next_cursor=None):
+    # streams {**extra, key: [...], ...} straight off an unbuffered server
+    # side cursor instead of building the whole payload in memory. Rows must
+    # come back grouped by key in the order of keys; split turns a row into
+    # (key, item). With a limit, "next" is added once a full page went out
+    conn = connect_to_db()
+    cursor = conn.cursor(pymysql.cursors.SSDictCursor)
+    dumps = current_app.json.dumps
+
+    def generate():
+        try:
+            cursor.execute(query, params)
+            chunk = ["{"]
+            for name, value in (extra or {}).items():
+                chunk.append(dumps(name) + ": " + dumps(value) + ", ")
+            pending = list(keys)
+            current = None
+            count = 0
+            last = None
+            for row in cursor:
+                key, item = split(row)
+                if key != current:
+                    while pending and pending[0] != key:
+                        chunk.append(dumps(pending.pop(0)) + ": [], ")
+                    pending.pop(0)
+                    if current is not None:
+                        chunk.append("], ")
+                    chunk.append(dumps(key) + ": [")
+                    current = key
+                else:
+                    chunk.append(", ")
+                chunk.append(dumps(item))
+                count += 1
+                last = row
+                if len(chunk) >= 256:
+                    yield "".join(chunk)
+                    chunk = []
+            if current is not None:
+                chunk.append("]")
+                if pending:
+                    chunk.append(", ")
+            chunk.append(", ".join(dumps(key) + ": []" for key in pending))
+            if limit is not None:
+                nxt = next_cursor(last) if count == limit else None
+                chunk.append(", \"next\": " + dumps(nxt))
+            chunk.append("}")
+            yield "".join(chunk)
+        finally:
+            cursor.close()
+            conn.close()
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def feed_page(feed, limit, after):
+    # keyset page over groupEvents followed by eventFeed, the cursor is the
+    # UEID of the last event already handed out
+    combined = [("groupEvents", event) for event in feed["groupEvents"]]
+    combined += [("eventFeed", event) for event in feed["eventFeed"]]
+    start = 0
+    if after is not None:
+        positions = [i for i, (_, event) in enumerate(combined) if event["UEID"] == after[0]]
+        if not positions:
+            raise BadCursor("Cursor is no longer part of this feed, start over")
+        start = positions[0] + 1
+
+    page = {"groupEvents": [], "eventFeed": []}
+    for key, event in combined[start:start + limit]:
+        page[key].append(event)
+    more = start + limit < len(combined)
+    page["next"] = encode_cursor(combined[start + limit - 1][1]["UEID"]) if more else None
+    return page
+
+
+# upcoming events from a set of hosts, see MembershipGraph.hosts_for
+HOSTED_EVENTS_Q = """
+    SELECT e.*, u.userName AS hostName
+    FROM events e
+    JOIN users u ON e.eventHost = u.UUID
+    WHERE e.eventHost IN ({})
+    AND e.date >= NOW()
+"""
+
+PROFILE_Q = "SELECT prefs, dist FROM prefs WHERE UUID = %s"
+
+
+def assemble_feed(key, lat, long, groupEvents, profile):
+    # builds (and caches) the feed from the user's group events and their
+    # profile, the public part comes from the cell's snapshot of the already
+    # loaded event_grid
+    dist = profile["dist"] if profile["dist"] is not None else DEFAULT_DIST
+    prefs = profile["tokens"]
+    logger.debug("Prefs: %s", prefs)
+
+    # Get list of public events within distance, skipping the ones
+    # already showing up as group events
+    seen = set(event["UEID"] for event in groupEvents)
+    publicEvents = [event for event in snapshots.query(lat, long, float(dist))
+                    if event["UEID"] not in seen]
+
+    # Rank by the number of shared tags
+    if (len(prefs) == 0):
+        matching = publicEvents
+    else:
+        matching = event_grid.rank_by_tags(publicEvents, prefs)
+
+    feed = {
+        "groupEvents": groupEvents,
+        "eventFeed": matching
+    }
+    feed_cache.put(key, feed, cell_ranges(lat, long, float(dist)),
+                   [event["UEID"] for event in groupEvents + matching])
+    return feed
+
+
+class ProfileStore:
+    # write-through, LRU bounded copy of the prefs table. A profile is
+    # {"prefs": raw string, "tokens": parsed prefs, "dist": radius} and is
+    # replaced, never mutated, so readers can hold on to it. Entries expire
+    # after ttl seconds so other processes' writes show up eventually
+    def __init__(self, max_size=100000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._profiles = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def make(prefs, dist):
+        # dist as the INT column holds it, whatever type it came in as
+        return {"prefs": prefs, "tokens": frozenset(tokenize(prefs)), "dist": int(dist) if dist is not None else None}
+
+    def get(self, uuid):
+        with self._lock:
+            entry = self._profiles.get(str(uuid))
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._profiles[str(uuid)]
+                self._misses += 1
+                return None
+            self._profiles.move_to_end(str(uuid))
+            self._hits += 1
+            return entry[1]
+
+    def put(self, uuid, prefs, dist):
+        profile = self.make(prefs, dist)
+        with self._lock:
+            self._profiles[str(uuid)] = (time.monotonic() + self.ttl, profile)
+            self._profiles.move_to_end(str(uuid))
+            while len(self._profiles) > self.max_size:
+                self._profiles.popitem(last=False)
+        return profile
+
+    def update(self, uuid, **fields):
+        # applies a committed write, profiles that aren't loaded yet get
+        # read in full the next time they are needed
+        with self._lock:
+            entry = self._profiles.get(str(uuid))
+            if entry is None:
+                return
+            changed = dict(entry[1], **fields)
+            self._profiles[str(uuid)] = (time.monotonic() + self.ttl, self.make(changed["prefs"], changed["dist"]))
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._profiles),
+                "maxSize": self.max_size,
+                "ttl": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hitRate": round(self._hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+profiles = ProfileStore(
+    max_size=int(os.getenv("profile_cache_size", 100000)),
+    ttl=float(os.getenv("profile_cache_ttl", 300)),
+)
+
+
+def get_profile(uuid):
+    # the user's profile, from memory when possible, None if they have no
+    # prefs row
+    profile = profiles.get(uuid)
+    if profile is None:
+        rows = fetch_all(PROFILE_Q, (uuid,))
+        if rows:
+            profile = profiles.put(uuid, rows[0]["prefs"], rows[0]["dist"])
+    return profile
+
+
+ACCOUNT_Q = """
+    SELECT UUID, userName, accountType, isPrivate, parentAccount
+    FROM users WHERE userName = %s
+"""
+
+
+class AccountCache:
+    # username -> {"UUID", "userName", "accountType", "isPrivate",
+    # "parentAccount"}, LRU bounded and expiring after ttl seconds so other
+    # processes' changes show up eventually. Only existing accounts are
+    # cached. A successful login also stores an HMAC of the password under a
+    # per-process key (never the password), so repeat logins are checked in
+    # memory
+    def __init__(self, max_size=100000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._secret = os.urandom(32)
+        self._lock = threading.Lock()
+        self._accounts = collections.OrderedDict()
+        self._names = {}
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def key(username):
+        # userName compares case-insensitively in MySQL
+        return str(username).lower()
+
+    def digest(self, password):
+        return hmac.new(self._secret, str(password).encode(), hashlib.sha256).digest()
+
+    def get(self, username):
+        key = self.key(username)
+        with self._lock:
+            entry = self._accounts.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                self._misses += 1
+                return None
+            self._accounts.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def put(self, account, password=None):
+        # returns the stored copy, rows aren't shared with the caller
+        key = self.key(account["userName"])
+        account = {k: account[k] for k in ("UUID", "userName", "accountType", "isPrivate", "parentAccount") if k in account}
+        digest = self.digest(password) if password is not None else None
+        with self._lock:
+            old = self._accounts.get(key)
+            if digest is None and old is not None and old[1]["UUID"] == account["UUID"]:
+                digest = old[2]
+            self._drop(key)
+            self._accounts[key] = (time.monotonic() + self.ttl, account, digest)
+            self._names[str(account["UUID"])] = key
+            while len(self._accounts) > self.max_size:
+                self._drop(next(iter(self._accounts)))
+        return account
+
+    def check_password(self, username, password):
+        # the cached account if password matches what last logged in
+        key = self.key(username)
+        digest = self.digest(password)
+        with self._lock:
+            entry = self._accounts.get(key)
+            if entry is None or entry[0] < time.monotonic() or entry[2] is None:
+                self._misses += 1
+                return None
+            if not hmac.compare_digest(entry[2], digest):
+                self._misses += 1
+                return None
+            self._hits += 1
+            return entry[1]
+
+    def _drop(self, key):
+        entry = self._accounts.pop(key, None)
+        if entry is not None:
+            self._names.pop(str(entry[1]["UUID"]), None)
+
+    def forget(self, username=None, uuid=None):
+        with self._lock:
+            if username is not None:
+                self._drop(self.key(username))
+            if uuid is not None:
+                key = self._names.get(str(uuid))
+                if key is not None:
+                    self._drop(key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._accounts),
+                "maxSize": self.max_size,
+                "ttl": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hitRate": round(self._hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+accounts = AccountCache(
+    max_size=int(os.getenv("account_cache_size", 100000)),
+    ttl=float(os.getenv("account_cache_ttl", 300)),
+)
+
+
+def resolve_account(cursor, username):
+    # the account behind username, from memory when possible, None if there
+    # is no such user
+    account = accounts.get(username)
+    if account is None:
+        cursor.execute(ACCOUNT_Q, (username,))
+        row = cursor.fetchone()
+        if row:
+            account = accounts.put(row)
+    return account
+
+
+INSERT_EVENT_Q = """
+    INSERT INTO events VALUES (NULL, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
+    (SELECT isPrivate FROM users WHERE UUID = %s))
+"""
+
+
+def event_values(UUID, event, lat, lng):
+    # INSERT_EVENT_Q parameters for a createEvent body, lat/lng are None
+    # when geocoding is deferred
+    return (
+        UUID,
+        event.get('eventName'),
+        event.get('date'),
+        event.get('address'),
+        round(lat, 3) if lat is not None else None,
+        round(lng, 3) if lng is not None else None,
+        event.get('desc'),
+        event.get('tags'),
+        event.get('cap'),
+        hashC(lat) if lat is not None else None,
+        hashC(lng) if lng is not None else None,
+        UUID
+    )
+
+
+def fetch_all(query, params):
+    # one query on its own pooled connection
+    conn = connect_to_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+class StageTimings:
+    # running count/avg/max (in ms) per named stage
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def record(self, stage, seconds):
+        with self._lock:
+            s = self._stages.setdefault(stage, {"count": 0, "total": 0.0, "max": 0.0})
+            s["count"] += 1
+            s["total"] += seconds
+            s["max"] = max(s["max"], seconds)
+
+    def timed(self, stage, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def stats(self):
+        with self._lock:
+            return {
+                stage: {
+                    "count": s["count"],
+                    "avgMs": round(s["total"] / s["count"] * 1000, 3),
+                    "maxMs": round(s["max"] * 1000, 3),
+                }
+                for stage, s in self._stages.items()
+            }
+
+
+feed_executor = ThreadPoolExecutor(max_workers=int(os.getenv("feed_fanout_workers", 16)), thread_name_prefix="feed")
+feed_timings = StageTimings()
+
+
+def load_public_events():
+    return [EventRecord(row) for row in fetch_all(PUBLIC_EVENTS_Q, None)]
+
+
+event_grid = EventGrid(refresh=float(os.getenv("event_index_refresh", 300)))
+
+
+def cell_bounds(cell):
+    # the coordinates hashC maps to cell. int() truncates towards zero, so
+    # cell 0 reaches to both sides of it
+    lo = (cell - 1 if cell <= 0 else cell) / 10
+    hi = (cell + 1 if cell >= 0 else cell) / 10
+    return lo, hi
+
+
+class CellSnapshots:
+    # per (latHash, longHash, radius) of the feeds being asked for, every
+    # upcoming public event some point in that cell could see, sorted by
+    # distance from the cell's center with the coordinates in radians and
+    # the tag tokens already worked out (the EventRecords themselves). Feeds
+    # from one cell share the snapshot and only sort it by their own
+    # distances, which is cheap as it is nearly in order already. New and
+    # deleted events are patched in, a background refresher rebuilds the
+    # snapshots in use from the grid and drops the idle ones
+    def __init__(self, grid, max_size=500, refresh=60, idle=600):
+        self.grid = grid
+        self.max_size = max_size
+        self.refresh = refresh
+        self.idle = idle
+        self._lock = threading.Lock()
+        self._snapshots = collections.OrderedDict()
+        self._changes = 0
+        self._thread = None
+        self._hits = 0
+        self._misses = 0
+        self._patches = 0
+        self._refreshes = 0
+        self._last_ms = None
+
+    @staticmethod
+    def key(lat, long, radius):
+        return (hashC(lat), hashC(long), float(radius))
+
+    @staticmethod
+    def area(key):
+        # the cell's center and how far from it the snapshot has to reach:
+        # the radius plus the distance to the cell's farthest corner
+        lat_lo, lat_hi = cell_bounds(key[0])
+        long_lo, long_hi = cell_bounds(key[1])
+        lat, long = (lat_lo + lat_hi) / 2, (long_lo + long_hi) / 2
+        corner = max(get_distance(lat, long, a, b) for a in (lat_lo, lat_hi) for b in (long_lo, long_hi))
+        return lat, long, key[2] + corner * 1.01
+
+    @staticmethod
+    def _make(area, events, dists, used):
+        lats = [event.radLat for event in events]
+        longs = [event.radLong for event in events]
+        if np is not None:
+            lats = np.array(lats, dtype=float)
+            longs = np.array(longs, dtype=float)
+        expiries = [expiry for expiry in map(expires_at, events) if expiry is not None]
+        return {
+            "area": area,
+            "events": events,
+            "dists": dists,
+            "lats": lats,
+            "longs": longs,
+            "ueids": set(event.UEID for event in events),
+            "expires": min(expiries) if expiries else None,
+            "used": used,
+        }
+
+    def _build(self, key, used):
+        area = self.area(key)
+        events = self.grid.query(*area)
+        dists = batch_distances(area[0], area[1], [event.radLat for event in events],
+                                [event.radLong for event in events], radians=True)
+        return self._make(area, events, list(dists.tolist() if np is not None else dists), used)
+
+    def _store(self, key, snapshot):
+        self._snapshots[key] = snapshot
+        self._snapshots.move_to_end(key)
+        while len(self._snapshots) > self.max_size:
+            self._snapshots.popitem(last=False)
+
+    def snapshot(self, lat, long, radius):
+        key = self.key(lat, long, radius)
+        now = time.monotonic()
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is not None and (snapshot["expires"] is None or snapshot["expires"] > datetime.datetime.now()):
+                self._snapshots.move_to_end(key)
+                snapshot["used"] = now
+                self._hits += 1
+                return snapshot
+            self._misses += 1
+            changes = self._changes
+
+        snapshot = self._build(key, now)
+        with self._lock:
+            # a patch landing mid-build may be missing from it, leave the
+            # next request to build again
+            if self._changes == changes:
+                self._store(key, snapshot)
+        return snapshot
+
+    def query(self, lat, long, radius):
+        # same as self.grid.query(lat, long, radius)
+        if self.max_size <= 0:
+            return self.grid.query(lat, long, radius)
+        snapshot = self.snapshot(lat, long, radius)
+        order, _ = nearest(lat, long, snapshot["lats"], snapshot["longs"], radius=radius, radians=True)
+        events = snapshot["events"]
+        return [events[i] for i in order]
+
+    def _drop(self, ueid):
+        for key, snapshot in list(self._snapshots.items()):
+            if ueid in snapshot["ueids"]:
+                keep = [i for i, event in enumerate(snapshot["events"]) if event.UEID != ueid]
+                self._snapshots[key] = self._make(snapshot["area"], [snapshot["events"][i] for i in keep],
+                                                  [snapshot["dists"][i] for i in keep], snapshot["used"])
+                self._patches += 1
+
+    def add(self, event):
+        # a new (or newly geocoded) event, into every snapshot reaching it
+        with self._lock:
+            self._changes += 1
+            self._drop(event.UEID)
+            if event.isPrivate or event.lat is None or event.long is None or not is_upcoming(event):
+                return
+            for key, snapshot in list(self._snapshots.items()):
+                lat, long, reach = snapshot["area"]
+                dist = get_distance(lat, long, event.lat, event.long)
+                if dist > reach:
+                    continue
+                i = bisect.bisect_right(snapshot["dists"], dist)
+                self._snapshots[key] = self._make(snapshot["area"],
+                                                  snapshot["events"][:i] + [event] + snapshot["events"][i:],
+                                                  snapshot["dists"][:i] + [dist] + snapshot["dists"][i:],
+                                                  snapshot["used"])
+                self._patches += 1
+
+    def remove(self, ueid):
+        with self._lock:
+            self._changes += 1
+            self._drop(ueid)
+
+    def refresh_once(self):
+        # drops the snapshots nobody asked for in self.idle seconds and
+        # rebuilds the rest, picking up grid reloads and expired events
+        started = time.perf_counter()
+        now = time.monotonic()
+        with self._lock:
+            for key in [key for key, snapshot in self._snapshots.items() if now - snapshot["used"] > self.idle]:
+                del self._snapshots[key]
+            keys = list(self._snapshots)
+            changes = self._changes
+        for key in keys:
+            with self._lock:
+                old = self._snapshots.get(key)
+            if old is None:
+                continue
+            snapshot = self._build(key, old["used"])
+            with self._lock:
+                if self._changes == changes and key in self._snapshots:
+                    snapshot["used"] = self._snapshots[key]["used"]
+                    self._snapshots[key] = snapshot
+                changes = self._changes
+        with self._lock:
+            self._refreshes += 1
+            self._last_ms = round((time.perf_counter() - started) * 1000, 3)
+
+    def start(self):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh)
+            try:
+                self.refresh_once()
+            except Exception as e:
+                logger.exception("Refreshing the feed snapshots failed: %s", e)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._snapshots),
+                "maxSize": self.max_size,
+                "events": sum(len(snapshot["events"]) for snapshot in self._snapshots.values()),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hitRate": round(self._hits / lookups, 4) if lookups else 0.0,
+                "patches": self._patches,
+                "refreshes": self._refreshes,
+                "lastRefreshMs": self._last_ms,
+            }
+
+
+snapshots = CellSnapshots(
+    event_grid,
+    max_size=int(os.getenv("snapshot_cells", 500)),
+    refresh=float(os.getenv("snapshot_refresh", 60)),
+    idle=float(os.getenv("snapshot_idle", 600)),
+)
+
+
+class MembershipGraph(LoadedIndex):
+    # in-process copy of who is in (or invited to) which group and which
+    # accounts are sub-accounts of which parent, so the feed and the group
+    # routes don't have to walk userGroups/users on every call
+    name = "membership graph"
+
+    def __init__(self, refresh=300):
+        super().__init__(refresh)
+        self._groups = {}
+        self._invites = {}
+        self._members = {}
+        self._parent = {}
+        self._children = {}
+        self._names = {}
+
+    @staticmethod
+    def _link(index, a, b):
+        index.setdefault(a, set()).add(b)
+
+    @staticmethod
+    def _unlink(index, a, b):
+        linked = index.get(a)
+        if linked is not None:
+            linked.discard(b)
+            if not linked:
+                del index[a]
+
+    def _account(self, uuid, name, parent):
+        uuid = int(uuid)
+        if name is not None:
+            self._names[uuid] = name
+        old = self._parent.pop(uuid, None)
+        if old is not None:
+            self._unlink(self._children, old, uuid)
+        if parent is not None:
+            self._parent[uuid] = int(parent)
+            self._link(self._children, int(parent), uuid)
+
+    def _invite(self, user, group):
+        self._link(self._invites, int(user), int(group))
+
+    def _join(self, user, group):
+        user, group = int(user), int(group)
+        self._unlink(self._invites, user, group)
+        self._link(self._groups, user, group)
+        self._link(self._members, group, user)
+
+    def _leave(self, user, group):
+        user, group = int(user), int(group)
+        self._unlink(self._invites, user, group)
+        self._unlink(self._groups, user, group)
+        self._unlink(self._members, group, user)
+
+    def _rebuild(self, data):
+        accounts, memberships = data
+        self._groups = {}
+        self._invites = {}
+        self._members = {}
+        self._parent = {}
+        self._children = {}
+        self._names = {}
+        for row in accounts:
+            self._account(row["UUID"], row["userName"], row["parentAccount"])
+        for row in memberships:
+            if row["pending"]:
+                self._invite(row["userID"], row["groupID"])
+            else:
+                self._join(row["userID"], row["groupID"])
+        # anything may have changed underneath the group and invite lists
+        versions.bump("membership", "all")
+
+    def add_account(self, uuid, name, parent=None):
+        self._apply(self._account, uuid, name, parent)
+
+    def invite(self, user, group):
+        self._apply(self._invite, user, group)
+
+    def join(self, user, group):
+        self._apply(self._join, user, group)
+
+    def leave(self, user, group):
+        self._apply(self._leave, user, group)
+
+    def groups(self, user):
+        with self._lock:
+            return sorted(self._groups.get(int(user), ()))
+
+    def invites(self, user):
+        with self._lock:
+            return sorted(self._invites.get(int(user), ()))
+
+    def hosts_for(self, user):
+        # accounts whose events show up in the user's group feed: their
+        # groups plus those groups' parent accounts
+        with self._lock:
+            groups = self._groups.get(int(user), set())
+            return groups | set(self._parent[group] for group in groups if group in self._parent)
+
+    def audience(self, host):
+        # the reverse of hosts_for, everyone whose group feed shows host
+        with self._lock:
+            host = int(host)
+            users = set(self._members.get(host, ()))
+            for child in self._children.get(host, ()):
+                users |= self._members.get(child, set())
+            return users
+
+    def names(self, uuids):
+        # {UUID: userName} for the ones known, the rest are left out
+        with self._lock:
+            return {uuid: self._names[uuid] for uuid in uuids if uuid in self._names}
+
+
+MEMBERSHIP_ACCOUNTS_Q = """
+    SELECT UUID, userName, parentAccount
+    FROM users
+    WHERE accountType != 1 OR parentAccount IS NOT NULL
+    OR UUID IN (SELECT groupID FROM userGroups)
+"""
+
+
+def load_memberships():
+    return (fetch_all(MEMBERSHIP_ACCOUNTS_Q, None),
+            fetch_all("SELECT userID, groupID, pending FROM userGroups", None))
+
+
+def group_names(uuids):
+    # names for a list of group UUIDs, in the same order, fetching any the
+    # graph hasn't seen yet (it only preloads group-like accounts)
+    names = membership.names(uuids)
+    missing = [uuid for uuid in uuids if uuid not in names]
+    if missing:
+        rows = fetch_all("SELECT UUID, userName, parentAccount FROM users WHERE UUID IN (" + placeholders(missing) + ")", missing)
+        for row in rows:
+            membership.add_account(row["UUID"], row["userName"], row["parentAccount"])
+            names[row["UUID"]] = row["userName"]
+    return [names[uuid] for uuid in uuids if uuid in names]
+
+
+def group_page(uuids, limit, after):
+    # keyset page over a sorted list of group UUIDs, returns (page, next)
+    if after is not None:
+        uuids = [uuid for uuid in uuids if uuid > after[0]]
+    if limit is None or len(uuids) <= limit:
+        return uuids, None
+    return uuids[:limit], encode_cursor(uuids[limit - 1])
+
+
+def fetch_group_events(uuid):
+    # events from groups the user is a part of
+    membership.ensure_loaded(load_memberships)
+    hosts = sorted(membership.hosts_for(uuid))
+    if not hosts:
+        return []
+    return [EventRecord(row) for row in fetch_all(HOSTED_EVENTS_Q.format(placeholders(hosts)), hosts)]
+
+
+membership = MembershipGraph(refresh=float(os.getenv("membership_refresh", 300)))
+
+
+class FeedCache:
+    # TTL + LRU cache of assembled feeds keyed by (UUID, latHash, longHash).
+    # Each entry remembers the cells its radius covered and the events it
+    # holds so writes can drop exactly the feeds they could have changed
+    def __init__(self, max_size=1000, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    @staticmethod
+    def key(uuid, lat, long):
+        return (str(uuid), hashC(lat), hashC(long))
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["expires"] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                    self._evictions += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry["value"]
+
+    def put(self, key, value, cells, ueids):
+        with self._lock:
+            self._entries[key] = {
+                "value": value,
+                "expires": time.monotonic() + self.ttl,
+                "cells": cells,
+                "ueids": set(ueids),
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def _drop(self, match):
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if match(key, entry)]
+            for key in stale:
+                del self._entries[key]
+            self._invalidations += len(stale)
+
+    def invalidate_users(self, uuids):
+        uuids = set(str(uuid) for uuid in uuids)
+        self._drop(lambda key, entry: key[0] in uuids)
+
+    def invalidate_user(self, uuid):
+        self.invalidate_users([uuid])
+
+    def invalidate_cell(self, cell):
+        def covers(key, entry):
+            lat_cells, long_ranges = entry["cells"]
+            return cell[0] in lat_cells and any(cell[1] in r for r in long_ranges)
+        self._drop(covers)
+
+    def invalidate_event(self, ueid):
+        self._drop(lambda key, entry: ueid in entry["ueids"])
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._entries),
+                "maxSize": self.max_size,
+                "ttl": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hitRate": round(self._hits / lookups, 4) if lookups else 0.0,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+            }
+
+
+feed_cache = FeedCache(
+    max_size=int(os.getenv("feed_cache_size", 1000)),
+    ttl=float(os.getenv("feed_cache_ttl", 30)),
+)
+
+
+class Versions:
+    # change counters behind the ETags of the read routes. Entities are
+    # keys like ("event", UEID) or ("prefs", UUID), write routes bump them
+    # after committing. A read remembers which entities its response was
+    # built from, so the next If-None-Match is answered from the counters
+    # alone. Counters are per process, the epoch stops an ETag handed out
+    # by an earlier process from matching a restarted count, and a response
+    # is only vouched for max_age seconds so writes other processes handled
+    # (and didn't broadcast) show up after that
+    def __init__(self, max_size=100000, max_age=60):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.epoch = base64.urlsafe_b64encode(os.urandom(6)).decode()
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._bumped = {}
+        self._resources = collections.OrderedDict()
+        self._checks = 0
+        self._not_modified = 0
+
+    def seq(self):
+        # take before reading, see remember
+        with self._lock:
+            return self._seq
+
+    def bump(self, kind, *ids):
+        with self._lock:
+            for id in ids:
+                self._seq += 1
+                self._bumped[(kind, str(id))] = self._seq
+
+    def _etag(self, keys):
+        parts = [self.epoch] + ["%s:%s:%d" % (kind, id, self._bumped.get((kind, id), 0)) for kind, id in keys]
+        return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+    def remember(self, resource, keys, since, expires=None):
+        # the ETag for resource built from keys, None when one of them was
+        # bumped after since (the response may predate that write).
+        # expires is when the response goes stale on its own, e.g. when an
+        # event in it is no longer upcoming
+        keys = tuple((kind, str(id)) for kind, id in keys)
+        limit = datetime.datetime.now() + datetime.timedelta(seconds=self.max_age)
+        expires = min(expires, limit) if expires is not None else limit
+        with self._lock:
+            if any(self._bumped.get(key, 0) > since for key in keys):
+                self._resources.pop(resource, None)
+                return None
+            self._resources[resource] = (keys, expires)
+            self._resources.move_to_end(resource)
+            while len(self._resources) > self.max_size:
+                self._resources.popitem(last=False)
+            return self._etag(keys)
+
+    def current(self, resource, etags):
+        # resource's ETag if it is among the client's etags, else None
+        with self._lock:
+            self._checks += 1
+            entry = self._resources.get(resource)
+            if entry is None:
+                return None
+            keys, expires = entry
+            if expires is not None and datetime.datetime.now() >= expires:
+                del self._resources[resource]
+                return None
+            etag = self._etag(keys)
+            if not etags.contains(etag):
+                return None
+            self._resources.move_to_end(resource)
+            self._not_modified += 1
+            return etag
+
+    def stats(self):
+        with self._lock:
+            return {
+                "resources": len(self._resources),
+                "maxAge": self.max_age,
+                "entities": len(self._bumped),
+                "checks": self._checks,
+                "notModified": self._not_modified,
+            }
+
+
+versions = Versions(
+    max_size=int(os.getenv("etag_max_resources", 100000)),
+    max_age=float(os.getenv("etag_max_age", 60)),
+)
+
+
+def request_resource():
+    # what a read route's response depends on besides the entities: its
+    # path and arguments (paging included)
+    return (request.path, tuple(sorted((k, v) for k, v in request.args.items(multi=True) if k != "profile")))
+
+
+def not_modified():
+    # a 304 for a client already holding the current version, None otherwise
+    if not request.if_none_match:
+        return None
+    etag = versions.current(request_resource(), request.if_none_match)
+    if etag is None:
+        return None
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def tagged(response, keys, since, expires=None):
+    etag = versions.remember(request_resource(), keys, since, expires)
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+
+class Subscription:
+    # one client listening on the EventBus: its own user id plus the hashC
+    # cells around where it is. Messages wait in a bounded queue, a client
+    # that falls behind gets a "reset" (refetch everything) and is dropped
+    def __init__(self, uuid, lat=None, long=None, radius=None, max_queued=100):
+        self.uuid = str(uuid)
+        self.max_queued = max_queued
+        self.cells = set()
+        self.area = None
+        if lat is not None and long is not None and radius is not None:
+            lat_cells, long_ranges = cell_ranges(lat, long, radius)
+            if len(lat_cells) * sum(len(r) for r in long_ranges) <= EventBus.MAX_CELLS:
+                self.cells = set((a, b) for a in lat_cells for r in long_ranges for b in r)
+            else:
+                self.area = (lat_cells, long_ranges)
+        self.queue = queue.Queue()
+
+    def covers(self, cell):
+        if cell in self.cells:
+            return True
+        if self.area is None:
+            return False
+        lat_cells, long_ranges = self.area
+        return cell[0] in lat_cells and any(cell[1] in r for r in long_ranges)
+
+    def offer(self, item):
+        # False once the client is too far behind
+        if self.queue.qsize() >= self.max_queued:
+            with self.queue.mutex:
+                self.queue.queue.clear()
+            self.queue.put((item[0], "reset", "{}"))
+            return False
+        self.queue.put(item)
+        return True
+
+
+class EventBus:
+    # in-process publish/subscribe for event, signup and invite changes.
+    # A message goes to the listed users and, when it has a cell, to
+    # everyone watching that cell. The last `history` messages are kept so
+    # a reconnecting client can pick up after its Last-Event-ID. Ids are
+    # "epoch.seq" so one handed out by another process is never replayed
+    # against this one's sequence
+    MAX_CELLS = 400
+
+    def __init__(self, history=1000):
+        self.epoch = base64.urlsafe_b64encode(os.urandom(6)).decode()
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._users = {}
+        self._cells = {}
+        self._wide = set()
+        self._history = collections.deque(maxlen=history)
+        self._published = 0
+        self._delivered = 0
+        self._dropped = 0
+
+    def add(self, sub, last_id=None):
+        with self._lock:
+            self._users.setdefault(sub.uuid, set()).add(sub)
+            for cell in sub.cells:
+                self._cells.setdefault(cell, set()).add(sub)
+            if sub.area is not None:
+                self._wide.add(sub)
+
+            if last_id is None:
+                return sub
+            epoch, _, last_id = str(last_id).rpartition(".")
+            last_id = int(last_id) if epoch == self.epoch and last_id.isdigit() else None
+            if last_id is None or (self._history and last_id < self._history[0][0] - 1) or last_id > self._seq:
+                # missed more than we kept (or another process' id)
+                sub.offer((self._seq, "reset", "{}"))
+                return sub
+            for seq, kind, data, users, cell in self._history:
+                if seq > last_id and (sub.uuid in users or (cell is not None and sub.covers(cell))):
+                    sub.offer((seq, kind, data))
+        return sub
+
+    def remove(self, sub):
+        with self._lock:
+            self._unlink(sub)
+
+    def _unlink(self, sub):
+        subs = self._users.get(sub.uuid)
+        if subs is not None:
+            subs.discard(sub)
+            if not subs:
+                del self._users[sub.uuid]
+        for cell in sub.cells:
+            subs = self._cells.get(cell)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._cells[cell]
+        self._wide.discard(sub)
+
+    def publish(self, kind, payload, users=(), cell=None):
+        self.deliver(kind, encode_json(payload), users, cell)
+
+    def deliver(self, kind, data, users=(), cell=None):
+        # publish with the payload already encoded
+        users = frozenset(str(uuid) for uuid in users)
+        cell = tuple(cell) if cell is not None else None
+        with self._lock:
+            self._seq += 1
+            self._published += 1
+            self._history.append((self._seq, kind, data, users, cell))
+            if not self._users and not self._cells and not self._wide:
+                return
+            targets = set()
+            for uuid in users:
+                targets |= self._users.get(uuid, set())
+            if cell is not None:
+                targets |= self._cells.get(cell, set())
+                targets |= set(sub for sub in self._wide if sub.covers(cell))
+            for sub in targets:
+                if sub.offer((self._seq, kind, data)):
+                    self._delivered += 1
+                else:
+                    self._dropped += 1
+                    self._unlink(sub)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "subscribers": sum(len(subs) for subs in self._users.values()),
+                "watchedCells": len(self._cells),
+                "published": self._published,
+                "delivered": self._delivered,
+                "dropped": self._dropped,
+                "lastId": self._seq,
+            }
+
+
+bus = EventBus(history=int(os.getenv("bus_history", 1000)))
+SSE_HEARTBEAT = float(os.getenv("sse_heartbeat", 15))
+
+
+def sse_frame(item):
+    seq, kind, data = item
+    return "id: %s.%d\nevent: %s\ndata: %s\n\n" % (bus.epoch, seq, kind, data)
+
+
+def publish_event(kind, event, payload, users=()):
+    # to the host's audience, the host, and for public events anyone watching
+    # its cell. event is an EventRecord or a row with eventHost/lat/long
+    users = set(users)
+    if event.get("eventHost") is not None:
+        users |= membership.audience(event["eventHost"])
+        users.add(event["eventHost"])
+    cell = None
+    if not event.get("isPrivate") and event.get("lat") is not None and event.get("long") is not None:
+        cell = cell_of(event)
+    bus.publish(kind, payload, users, cell)
+
+
+def publish_signup(ueid, uuid, change):
+    # the public ones reach their cell and host through the grid, a private
+    # event's update only goes to the user
+    event = event_grid.get(int(ueid))
+    payload = {"type": "signUp", "UEID": int(ueid), "UUID": int(uuid), "change": change}
+    if event is not None:
+        publish_event("signUp", event, payload, [uuid])
+    else:
+        bus.publish("signUp", payload, [uuid])
+
+
+def placeholders(values):
+    # "%s, %s, %s" for an IN (...) over values
+    return ", ".join(["%s"] * len(values))
+
+
+# largest multi-row INSERT we build ourselves, well under pymysql's
+# max_stmt_length and the server's default max_allowed_packet
+INSERT_CHUNK_BYTES = int(os.getenv("insert_chunk_bytes", 512 * 1024))
+
+
+def value_chunks(cursor, template, rows, max_bytes=INSERT_CHUNK_BYTES):
+    # rows rendered through template ("(%s, %s, ...)") and grouped so that
+    # each group's VALUES list stays under max_bytes
+    chunk = []
+    size = 0
+    for row in rows:
+        value = cursor.mogrify(template, row)
+        length = len(value.encode()) + 1
+        if chunk and size + length > max_bytes:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(value)
+        size += length
+    if chunk:
+        yield chunk
+
+
+def events_created(cursor, ueids):
+    # brings the in-process indexes and caches up to date with newly
+    # inserted (or newly geocoded) events, cursor must see the committed rows
+    ueids = list(ueids)
+    if not ueids:
+        return []
+    cursor.execute(EVENTS_BY_ID_Q.format(placeholders(ueids)), ueids)
+    events = [EventRecord(row) for row in cursor.fetchall()]
+
+    for event in events:
+        event_grid.add(event)
+        snapshots.add(event)
+    cluster.send("grid.index", ueids)
+    versions.bump("event", *ueids)
+    versions.bump("user", *set(event["eventHost"] for event in events))
+
+    # drop the cached feeds that could now include these events
+    membership.ensure_loaded(load_memberships)
+    for host in set(event["eventHost"] for event in events):
+        feed_cache.invalidate_users(membership.audience(host))
+    for cell in set(cell_of(event) for event in events
+                    if event.get("lat") is not None and event.get("long") is not None):
+        feed_cache.invalidate_cell(cell)
+    for event in events:
+        publish_event("eventCreated", event, {"type": "eventCreated", "event": event})
+    return events
+
+
+def event_created(cursor, ueid):
+    events = events_created(cursor, [ueid])
+    return events[0] if events else None
+
+
+def event_deleted(ueid):
+    event_grid.remove(ueid)
+    snapshots.remove(ueid)
+    feed_cache.invalidate_event(ueid)
+    versions.bump("event", ueid)
+
+
+ARCHIVE_CANDIDATES_Q = """
+    SELECT UEID FROM events WHERE date < %s ORDER BY date, UEID LIMIT %s
+"""
+
+
+class Archiver:
+    # moves events that ended more than `after` seconds ago, with their
+    # signedUp rows, into eventsArchive/signedUpArchive. Each chunk of
+    # `batch` events is its own short transaction locking only those rows,
+    # with a pause in between so live writes get a turn
+    def __init__(self, batch=500, after=86400, interval=3600, pause=0.1):
+        self.batch = batch
+        self.after = after
+        self.interval = interval
+        self.pause = pause
+        self._lock = threading.Lock()
+        self._thread = None
+        self._archived = 0
+        self._runs = 0
+        self._last_run = None
+        self._last_ms = 0.0
+
+    def archive_once(self):
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=self.after)
+        start = time.perf_counter()
+        moved = 0
+        while True:
+            n = self._move_chunk(cutoff)
+            moved += n
+            if n < self.batch:
+                break
+            time.sleep(self.pause)
+        with self._lock:
+            self._archived += moved
+            self._runs += 1
+            self._last_run = datetime.datetime.now().isoformat(timespec="seconds")
+            self._last_ms = round((time.perf_counter() - start) * 1000, 3)
+        if moved:
+            logger.info("Archived %d past events", moved)
+        return moved
+
+    def _move_chunk(self, cutoff):
+        conn = connect_to_db()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(ARCHIVE_CANDIDATES_Q, (cutoff, self.batch))
+            ueids = [row["UEID"] for row in cursor.fetchall()]
+            if not ueids:
+                return 0
+            marks = placeholders(ueids)
+            cursor.execute("INSERT IGNORE INTO eventsArchive SELECT * FROM events WHERE UEID IN ({})".format(marks), ueids)
+            cursor.execute("INSERT IGNORE INTO signedUpArchive SELECT * FROM signedUp WHERE UEID IN ({})".format(marks), ueids)
+            cursor.execute("DELETE FROM signedUp WHERE UEID IN ({})".format(marks), ueids)
+            cursor.execute("DELETE FROM signUpCounts WHERE UEID IN ({})".format(marks), ueids)
+            cursor.execute("DELETE FROM events WHERE UEID IN ({})".format(marks), ueids)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+        for ueid in ueids:
+            event_deleted(ueid)
+        return len(ueids)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.archive_once()
+            except Exception as e:
+                logger.exception("Archiving past events failed: %s", e)
+            time.sleep(self.interval)
+
+    def stats(self):
+        with self._lock:
+            expiry = event_grid.next_expiry()
+            return {
+                "archived": self._archived,
+                "runs": self._runs,
+                "lastRun": self._last_run,
+                "lastRunMs": self._last_ms,
+                "nextExpiry": expiry.isoformat(timespec="seconds") if expiry else None,
+            }
+
+
+archiver = Archiver(
+    batch=int(os.getenv("archive_batch", 500)),
+    after=float(os.getenv("archive_after_hours", 24)) * 3600,
+    interval=float(os.getenv("archive_interval", 3600)),
+    pause=float(os.getenv("archive_pause", 0.1)),
+)
+
+
+class WriteBehind:
+    # optional queue for idempotent writes (write_behind=1). Each write is a
+    # function of a cursor stored under a key like ("prefs", UUID), so a
+    # newer write to the same key replaces the queued one. A worker commits
+    # them in batches of max_batch once that many are queued or the oldest
+    # has waited interval seconds, and whatever is left goes at exit. When a
+    # batch fails its writes are retried one by one, a write failing
+    # max_retries times is logged and dropped so it can't hold up the rest
+    def __init__(self, enabled=False, max_batch=200, interval=0.5, max_retries=5):
+        self.enabled = enabled
+        self.max_batch = max_batch
+        self.interval = interval
+        self.max_retries = max_retries
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pending = collections.OrderedDict()
+        self._oldest = None
+        self._worker = None
+        self._closed = False
+        self._queued = 0
+        self._coalesced = 0
+        self._written = 0
+        self._failures = 0
+        self._dropped = 0
+        self._last_ms = 0.0
+
+    def put(self, key, write, done=None):
+        with self._cond:
+            if key in self._pending:
+                self._coalesced += 1
+                del self._pending[key]
+            self._pending[key] = (write, done, 0)
+            self._queued += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, daemon=True)
+                self._worker.start()
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._closed and (
+                        not self._pending
+                        or (len(self._pending) < self.max_batch
+                            and time.monotonic() - self._oldest < self.interval)):
+                    timeout = None if not self._pending else self.interval - (time.monotonic() - self._oldest)
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("Write-behind flush failed: %s", e)
+                time.sleep(self.interval)
+
+    def _take(self, limit=None):
+        with self._cond:
+            keys = list(self._pending)[:limit]
+            batch = [(key, self._pending.pop(key)) for key in keys]
+            self._oldest = time.monotonic() if self._pending else None
+            return batch
+
+    def _requeue(self, batch):
+        # writes queued since then are newer and win
+        with self._cond:
+            for key, entry in batch:
+                if key not in self._pending:
+                    self._pending[key] = entry
+                    self._pending.move_to_end(key, last=False)
+            if self._pending and self._oldest is None:
+                self._oldest = time.monotonic()
+
+    def _one_by_one(self, conn, cursor, batch):
+        # after a failed batch: each write in its own transaction, returns
+        # the ones that committed and the ones that failed
+        committed = []
+        failed = []
+        for key, entry in batch:
+            try:
+                entry[0](cursor)
+                conn.commit()
+                committed.append((key, entry))
+            except Exception as e:
+                conn.rollback()
+                failed.append((key, entry, e))
+        return committed, failed
+
+    def _commit(self, batch):
+        # commits batch, returns how many writes were put back for a retry
+        start = time.perf_counter()
+        try:
+            conn = connect_to_db()
+        except Exception:
+            # nothing got to run, try the whole batch again later
+            with self._cond:
+                self._failures += 1
+            self._requeue(batch)
+            raise
+        cursor = conn.cursor()
+        try:
+            try:
+                for _, entry in batch:
+                    entry[0](cursor)
+                conn.commit()
+                committed, failed = batch, []
+            except Exception as e:
+                conn.rollback()
+                logger.warning("Write-behind batch of %d failed (%s), retrying one by one", len(batch), e)
+                committed, failed = self._one_by_one(conn, cursor, batch)
+        finally:
+            cursor.close()
+            conn.close()
+
+        retry = []
+        for key, (write, done, attempts), e in failed:
+            if attempts + 1 >= self.max_retries:
+                logger.error("Dropping write-behind write %s after %d attempts: %s", key, attempts + 1, e)
+                with self._cond:
+                    self._dropped += 1
+            else:
+                retry.append((key, (write, done, attempts + 1)))
+        self._requeue(retry)
+
+        took = time.perf_counter() - start
+        metrics.observe("writeBehind", "flush", took, rows=len(committed))
+        with self._cond:
+            self._written += len(committed)
+            self._failures += len(failed)
+            self._last_ms = round(took * 1000, 3)
+        for _, (_, done, _) in committed:
+            if done is not None:
+                done()
+        return len(retry)
+
+    def flush(self):
+        # everything queued so far, max_batch writes per transaction. Writes
+        # put back for a retry wait for the next flush
+        with self._flush_lock:
+            while True:
+                batch = self._take(self.max_batch)
+                if not batch:
+                    return
+                if self._commit(batch):
+                    return
+
+    def flush_key(self, key):
+        # writes a queued key now, for routes that must not overtake it
+        if not self.enabled:
+            return
+        with self._flush_lock:
+            with self._cond:
+                entry = self._pending.pop(key, None)
+                if not self._pending:
+                    self._oldest = None
+            if entry is not None:
+                self._commit([(key, entry)])
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        # retries get their remaining attempts now, nothing comes after
+        try:
+            for _ in range(self.max_retries):
+                self.flush()
+                with self._cond:
+                    if not self._pending:
+                        return
+        except Exception as e:
+            logger.exception("Write-behind flush at shutdown failed: %s", e)
+        with self._cond:
+            if self._pending:
+                logger.error("Dropping %d write-behind writes at shutdown", len(self._pending))
+                self._dropped += len(self._pending)
+                self._pending.clear()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "enabled": self.enabled,
+                "depth": len(self._pending),
+                "queued": self._queued,
+                "coalesced": self._coalesced,
+                "written": self._written,
+                "failures": self._failures,
+                "dropped": self._dropped,
+                "lastFlushMs": self._last_ms,
+            }
+
+
+write_behind = WriteBehind(
+    enabled=os.getenv("write_behind") == "1",
+    max_batch=int(os.getenv("write_behind_batch", 200)),
+    interval=float(os.getenv("write_behind_interval", 0.5)),
+    max_retries=int(os.getenv("write_behind_retries", 5)),
+)
+atexit.register(write_behind.close)
+
+
+def run_write(key, write, done=None):
+    # write(cursor) now in its own transaction, or queued under key in
+    # write-behind mode. done runs once it is committed
+    if write_behind.enabled:
+        write_behind.put(key, write, done)
+        return
+    conn = connect_to_db()
+    cursor = conn.cursor()
+    try:
+        write(cursor)
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    if done is not None:
+        done()
+
+
+class RespError(Exception):
+    pass
+
+
+class LocalBackend:
+    # single process: key/values live in this process and invalidations
+    # have nobody else to reach
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._values = collections.OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                del self._values[key]
+                return None
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._values[key] = (value, time.monotonic() + ttl if ttl else None)
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def publish(self, channel, data):
+        pass
+
+    def listen(self, channel, handler):
+        pass
+
+    def close(self):
+        pass
+
+
+class RespBackend:
+    # Redis protocol over plain sockets: GET/SET/DEL for shared values and
+    # PUBLISH/SUBSCRIBE for invalidations, enough to run against Redis,
+    # Valkey or the stand-in in bench.py
+    def __init__(self, host="127.0.0.1", port=6379, db=0, password=None, timeout=2.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sock = None
+        self._reader = None
+        self._listeners = []
+        self._closed = False
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        parsed = urlparse(url)
+        db = parsed.path.strip("/")
+        return cls(parsed.hostname or "127.0.0.1", parsed.port or 6379,
+                   int(db) if db else 0, parsed.password, **kwargs)
+
+    @staticmethod
+    def encode(*args):
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(out)
+
+    @staticmethod
+    def read_reply(reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RespError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            if n < 0:
+                return None
+            data = reader.read(n + 2)
+            return data[:-2]
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [RespBackend.read_reply(reader) for _ in range(n)]
+        raise RespError("Unexpected reply " + repr(line))
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        reader = sock.makefile("rb")
+        for args in ([("AUTH", self.password)] if self.password else []) + ([("SELECT", self.db)] if self.db else []):
+            sock.sendall(self.encode(*args))
+            self.read_reply(reader)
+        return sock, reader
+
+    def command(self, *args):
+        # one retry on a fresh connection if the old one went away
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._sock, self._reader = self._connect()
+                    self._sock.sendall(self.encode(*args))
+                    return self.read_reply(self._reader)
+                except (OSError, ConnectionError):
+                    if self._sock is not None:
+                        self._sock.close()
+                    self._sock = self._reader = None
+                    if attempt:
+                        raise
+
+    def get(self, key):
+        value = self.command("GET", key)
+        return value.decode() if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        if ttl:
+            self.command("SET", key, value, "PX", int(ttl * 1000))
+        else:
+            self.command("SET", key, value)
+
+    def delete(self, key):
+        self.command("DEL", key)
+
+    def publish(self, channel, data):
+        self.command("PUBLISH", channel, data)
+
+    def listen(self, channel, handler):
+        # handler(data) for every message on channel, on a thread of its own
+        # that reconnects when the connection drops
+        thread = threading.Thread(target=self._listen, args=(channel, handler), daemon=True)
+        self._listeners.append(thread)
+        thread.start()
+
+    def _listen(self, channel, handler):
+        delay = 0.1
+        while not self._closed:
+            try:
+                sock, reader = self._connect()
+                sock.settimeout(None)
+                sock.sendall(self.encode("SUBSCRIBE", channel))
+                delay = 0.1
+                while not self._closed:
+                    reply = self.read_reply(reader)
+                    if not (isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message"):
+                        continue
+                    # one bad message must not take the subscription down
+                    try:
+                        data = reply[2].decode()
+                    except (AttributeError, UnicodeDecodeError) as e:
+                        logger.warning("Skipping an undecodable %s message: %s", channel, e)
+                        continue
+                    try:
+                        handler(data)
+                    except Exception as e:
+                        logger.exception("Handling a %s message failed: %s", channel, e)
+            except (OSError, ConnectionError, RespError) as e:
+                logger.warning("Lost the %s subscription (%s), reconnecting", channel, e)
+                time.sleep(delay)
+                delay = min(delay * 2, 5.0)
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = self._reader = None
+
+
+def make_backend(url):
+    # cache_url=redis://[:password@]host:port/db, anything else stays local
+    if url and url.startswith(("redis://", "resp://")):
+        return RespBackend.from_url(url)
+    return LocalBackend()
+
+
+cache_backend = make_backend(os.getenv("cache_url"))
+
+
+class GeocodeError(Exception):
+    def __init__(self, status):
+        super().__init__("Geocoding failed: " + str(status))
+        self.status = status
+
+
+def normalize_address(address):
+    # "  123 Main St. ,Denver CO " and "123 main st, denver co" share a cache entry
+    address = re.sub(r"\s*,\s*", ", ", (address or "").strip().lower())
+    address = re.sub(r"[.#]", "", address)
+    return re.sub(r"\s+", " ", address).strip(" ,")
+
+
+class GeocodeCache:
+    # on-disk normalized address -> (lat, lng) cache, least recently used
+    # entries are evicted once it holds more than max_entries. Hits only
+    # note the time in memory, the lastUsed column is brought up to date in
+    # batches of flush_every or every flush_interval seconds, and before
+    # anything is evicted
+    def __init__(self, path, max_entries=50000, flush_every=500, flush_interval=30.0):
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._touched = {}
+        self._flushed = time.monotonic()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS geocodes (
+                address TEXT PRIMARY KEY,
+                lat REAL NOT NULL,
+                lng REAL NOT NULL,
+                lastUsed REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS geocodesLastUsed ON geocodes (lastUsed)")
+        self._db.commit()
+        # counted once, put() keeps it current from here on
+        self._count = self._db.execute("SELECT COUNT(*) FROM geocodes").fetchone()[0]
+
+    def get(self, address):
+        with self._lock:
+            row = self._db.execute("SELECT lat, lng FROM geocodes WHERE address = ?", (address,)).fetchone()
+            if row is not None:
+                self._touched[address] = time.time()
+                if (len(self._touched) >= self.flush_every
+                        or time.monotonic() - self._flushed >= self.flush_interval):
+                    self._flush()
+                    self._db.commit()
+            return row
+
+    def _flush(self):
+        # callers hold the lock and commit
+        if self._touched:
+            self._db.executemany("UPDATE geocodes SET lastUsed = ? WHERE address = ?",
+                                 [(used, address) for address, used in self._touched.items()])
+            self._touched.clear()
+        self._flushed = time.monotonic()
+
+    def put(self, address, lat, lng):
+        with self._lock:
+            self._touched.pop(address, None)
+            updated = self._db.execute("UPDATE geocodes SET lat = ?, lng = ?, lastUsed = ? WHERE address = ?",
+                                       (lat, lng, time.time(), address)).rowcount
+            if not updated:
+                self._db.execute("INSERT INTO geocodes VALUES (?, ?, ?, ?)", (address, lat, lng, time.time()))
+                self._count += 1
+            if self._count > self.max_entries:
+                self._flush()
+                self._count -= self._db.execute("""
+                    DELETE FROM geocodes WHERE address IN (
+                        SELECT address FROM geocodes ORDER BY lastUsed LIMIT ?
+                    )
+                """, (self._count - self.max_entries,)).rowcount
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._count
+
+
+class Geocoder:
+    # address -> (lat, lng) through the cache first, then the geocoding API
+    # over a pooled session with strict timeouts. Point geo_coding_url at a
+    # local server to test against a fake geocoder
+    def __init__(self, url, key, cache, timeout=(2.0, 5.0), pool_size=10, shared=None, shared_ttl=30 * 86400):
+        self.url = url
+        self.key = key
+        self.cache = cache
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._failures = 0
+        self._api_time = 0.0
+
+        self._queue = queue.Queue()
+        self._worker = None
+
+    def geocode(self, address):
+        normalized = normalize_address(address)
+        cached = self.cache.get(normalized) or self.lookup_shared(normalized)
+        if cached is not None:
+            with self._lock:
+                self._hits += 1
+            return cached
+
+        with self._lock:
+            self._misses += 1
+        start = time.monotonic()
+        try:
+            response = self.session.get(self.url, params={'address': address, 'key': self.key}, timeout=self.timeout)
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            with self._lock:
+                self._failures += 1
+            raise GeocodeError(type(e).__name__)
+        finally:
+            with self._lock:
+                self._api_time += time.monotonic() - start
+            metrics.observe("geocoder", "api", time.monotonic() - start)
+
+        if data.get('status') != 'OK':
+            with self._lock:
+                self._failures += 1
+            raise GeocodeError(data.get('status'))
+
+        location = data['results'][0]['geometry']['location']
+        self.cache.put(normalized, location['lat'], location['lng'])
+        self.store_shared(normalized, location['lat'], location['lng'])
+        return location['lat'], location['lng']
+
+    # other nodes' lookups through the shared cache backend, when there is one
+    def lookup_shared(self, normalized):
+        if self.shared is None:
+            return None
+        try:
+            found = self.shared.get("geocode:" + normalized)
+        except (OSError, ConnectionError, RespError) as e:
+            logger.warning("Shared geocode cache unavailable: %s", e)
+            return None
+        if found is None:
+            return None
+        lat, lng = json.loads(found)
+        self.cache.put(normalized, lat, lng)
+        return lat, lng
+
+    def store_shared(self, normalized, lat, lng):
+        if self.shared is None:
+            return
+        try:
+            self.shared.set("geocode:" + normalized, json.dumps([lat, lng]), self.shared_ttl)
+        except (OSError, ConnectionError, RespError) as e:
+            logger.warning("Shared geocode cache unavailable: %s", e)
+
+    # deferred mode: the event is inserted without coordinates and this
+    # worker fills them (and the hashC buckets) in afterwards
+    def defer(self, ueid, address):
+        self.start_worker()
+        self._queue.put((ueid, address))
+
+    def start_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, daemon=True)
+                self._worker.start()
+
+    def _work(self):
+        while True:
+            ueid, address = self._queue.get()
+            try:
+                self._fill_in(ueid, address)
+            except Exception as e:
+                logger.warning("Deferred geocode failed for event %s: %s", ueid, e)
+            finally:
+                self._queue.task_done()
+
+    def _fill_in(self, ueid, address):
+        lat, lng = self.geocode(address)
+        conn = connect_to_db()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(FILL_IN_LOCATION_Q, (round(lat, 3), round(lng, 3), hashC(lat), hashC(lng), ueid))
+            conn.commit()
+            event_created(cursor, ueid)
+        finally:
+            cursor.close()
+            conn.close()
+
+    def requeue_missing(self):
+        # picks back up upcoming events a previous process never got to
+        conn = connect_to_db()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(MISSING_LOCATION_Q)
+            for row in cursor.fetchall():
+                self.defer(row["UEID"], row["address"])
+        finally:
+            cursor.close()
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "cacheHits": self._hits,
+                "cacheMisses": self._misses,
+                "hitRate": round(self._hits / lookups, 4) if lookups else 0.0,
+                "failures": self._failures,
+                "avgApiMs": round(self._api_time / self._misses * 1000, 3) if self._misses else 0.0,
+                "deferredQueue": self._queue.qsize(),
+            }
+
+
+FILL_IN_LOCATION_Q = """
+    UPDATE events SET lat = %s, `long` = %s, latHash = %s, longHash = %s
+    WHERE UEID = %s
+"""
+
+MISSING_LOCATION_Q = """
+    SELECT UEID, address FROM events WHERE lat IS NULL AND date >= NOW()
+"""
+
+
+geocoder = Geocoder(
+    url=os.getenv("geo_coding_url", 'https://maps.googleapis.com/maps/api/geocode/json'),
+    key=os.getenv("geo_coding_key"),
+    # opened by create_app, in the instance folder unless geo_cache_path
+    # points somewhere else
+    cache=None,
+    timeout=(float(os.getenv("geo_coding_connect_timeout", 2)), float(os.getenv("geo_coding_timeout", 5))),
+    shared=cache_backend if isinstance(cache_backend, RespBackend) else None,
+)
+
+
+def index_events(ueids):
+    # a peer's events_created: only the grid needs the rows, everything else
+    # it touched arrives as its own message
+    rows = fetch_all(EVENTS_BY_ID_Q.format(placeholders(ueids)), list(ueids)) if ueids else []
+    for event in map(EventRecord, rows):
+        event_grid.add(event)
+        snapshots.add(event)
+
+
+class Cluster:
+    # keeps the in-process caches of several app processes in step. Shared
+    # operations (cache invalidations, index updates, bus deliveries) run
+    # locally and are then broadcast on the backend's channel, peers replay
+    # them on their own copies. Replays are not broadcast again, and nothing
+    # is sent until start() is called with a backend that reaches a server
+    def __init__(self, backend, channel="events:invalidate", max_queued=10000):
+        self.backend = backend
+        self.channel = channel
+        self.origin = base64.urlsafe_b64encode(os.urandom(9)).decode()
+        self._ops = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._queue = None
+        self._max_queued = max_queued
+        self._thread = None
+        self._sent = 0
+        self._received = 0
+        self._failed = 0
+        self._dropped = 0
+        self._malformed = 0
+
+    def register(self, name, op):
+        self._ops[name] = op
+
+    def share(self, name, target, *methods):
+        # swaps target's methods for ones that also broadcast the call
+        for method in methods:
+            op = getattr(target, method)
+            self.register(name + "." + method, op)
+            setattr(target, method, self._shared(name + "." + method, op))
+
+    def _shared(self, name, op):
+        @functools.wraps(op)
+        def run(*args, **kwargs):
+            result = op(*args, **kwargs)
+            self.send(name, *args, **kwargs)
+            return result
+        return run
+
+    @staticmethod
+    def _default(o):
+        if isinstance(o, (set, frozenset)):
+            return sorted(o, key=str)
+        return json_default(o)
+
+    def send(self, name, *args, **kwargs):
+        if self._queue is None or getattr(self._local, "applying", False):
+            return
+        message = json.dumps({"origin": self.origin, "op": name, "args": args, "kwargs": kwargs},
+                             default=self._default)
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            # peers catch up through their TTLs and periodic reloads
+            with self._lock:
+                self._dropped += 1
+
+    def start(self):
+        if isinstance(self.backend, LocalBackend):
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._queue = queue.Queue(self._max_queued)
+                self._thread = threading.Thread(target=self._send_loop, daemon=True)
+                self._thread.start()
+                self.backend.listen(self.channel, self._receive)
+
+    def _send_loop(self):
+        while True:
+            message = self._queue.get()
+            try:
+                self.backend.publish(self.channel, message)
+                with self._lock:
+                    self._sent += 1
+            except (OSError, ConnectionError, RespError) as e:
+                logger.warning("Broadcasting an invalidation failed: %s", e)
+                with self._lock:
+                    self._failed += 1
+
+    def _receive(self, data):
+        try:
+            message = json.loads(data)
+            origin, name = message.get("origin"), message.get("op")
+            args, kwargs = message.get("args", []), message.get("kwargs", {})
+            if not isinstance(args, list) or not isinstance(kwargs, dict):
+                raise ValueError("args must be a list and kwargs an object")
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.warning("Skipping a malformed cluster message: %s", e)
+            with self._lock:
+                self._malformed += 1
+            return
+        if origin == self.origin:
+            return
+        op = self._ops.get(name)
+        if op is None:
+            logger.warning("Unknown cluster operation %s", name)
+            return
+        with self._lock:
+            self._received += 1
+        self._local.applying = True
+        try:
+            op(*args, **kwargs)
+        except Exception as e:
+            logger.exception("Replaying %s failed: %s", name, e)
+        finally:
+            self._local.applying = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": type(self.backend).__name__,
+                "running": self._thread is not None and self._thread.is_alive(),
+                "queued": self._queue.qsize() if self._queue is not None else 0,
+                "sent": self._sent,
+                "received": self._received,
+                "failed": self._failed,
+                "dropped": self._dropped,
+                "malformed": self._malformed,
+            }
+
+
+cluster = Cluster(cache_backend, channel=os.getenv("cache_channel", "events:invalidate"))
+cluster.register("grid.index", index_events)
+cluster.share("grid", event_grid, "remove")
+cluster.share("snapshots", snapshots, "remove")
+cluster.share("feed", feed_cache, "invalidate_users", "invalidate_cell", "invalidate_event")
+cluster.share("versions", versions, "bump")
+cluster.share("membership", membership, "add_account", "invite", "join", "leave")
+cluster.share("profiles", profiles, "update")
+cluster.share("accounts", accounts, "forget")
+cluster.share("bus", bus, "deliver")
 
-def connect_to_db():
-    # the pymysql connector
-    load_dotenv()
-    return pymysql.connect(
-        host=os.getenv("db_host"),
-        user=os.getenv("db_user"),
-        password=os.getenv("db_password"),
-        database=os.getenv("db_name"),
-        cursorclass=pymysql.cursors.DictCursor
-    )
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__, instance_relative_config=True)
+    app.json = EventJSONProvider(app)
     CORS(app)
     app.config.from_mapping(
         SECRET_KEY='dev',
@@ -58,38 +3148,115 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    if geocoder.cache is None:
+        geocoder.cache = GeocodeCache(
+            os.getenv("geo_cache_path") or os.path.join(app.instance_path, "geocode_cache.sqlite"),
+            max_entries=int(os.getenv("geo_cache_size", 50000)),
+        )
+
+    # route latency for /metrics, plus an opt-in sampling profile of a
+    # single request with ?profile=1 when profiling_enabled=1
+    profiling = os.getenv("profiling_enabled") == "1"
+
+    @app.before_request
+    def start_timer():
+        g.started = time.perf_counter()
+        g.profiler = None
+        if profiling and request.args.get("profile") == "1":
+            g.profiler = SamplingProfiler(threading.get_ident()).start()
+
+    @app.after_request
+    def record_timing(response):
+        took = time.perf_counter() - g.started
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.observe("routes", request.method + " " + route, took)
+        if g.profiler is not None:
+            profile = g.profiler.stop()
+            g.profiler = None
+            profile.update(route=route, ms=round(took * 1000, 3))
+            metrics.profiles.append(profile)
+            logger.info("Profile of %s: %s", route, profile)
+        return response
+
+    # after_request is skipped when a view raises, don't leave the
+    # sampling thread running then
+    @app.teardown_request
+    def stop_profiler(exc):
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profiler.stop()
+
+    # gzip/br for larger JSON bodies, whichever the client accepts
+    compressing = os.getenv("compress_responses", "1") == "1"
+
+    @app.after_request
+    def compress_response(response):
+        if (not compressing or response.direct_passthrough or response.is_streamed
+                or response.mimetype != "application/json" or "Content-Encoding" in response.headers):
+            return response
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = pick_encoding(request.headers.get("Accept-Encoding"))
+        if encoding is not None:
+            response.set_data(compress_body(data, encoding))
+            response.headers["Content-Encoding"] = encoding
+        return response
+
+    # pick back up events still waiting on deferred geocoding
+    if os.getenv("geo_coding_deferred") == "1":
+        threading.Thread(target=geocoder.requeue_missing, daemon=True).start()
+
+    # move past events out of the live tables in the background
+    if os.getenv("archive_enabled") == "1":
+        archiver.start()
+
+    # share cache invalidations with the other processes on cache_url
+    cluster.start()
+
+    # keep the per-cell public feed snapshots current
+    snapshots.start()
+
     # the login route for testing login details
     @app.route('/login', methods=['GET'])
     def login():
         username = request.args.get('username')
         password = request.args.get('password')
-        print(username + " " + password)
+        logger.debug("Login attempt for %s", username)
 
-        try:
-            conn = connect_to_db()
-            cursor = conn.cursor()
+        # a repeat login is checked against the cached digest
+        user = accounts.check_password(username, password)
+        if user is None:
+            try:
+                conn = connect_to_db()
+                cursor = conn.cursor()
 
-            query = "SELECT UUID, userName, accountType, isPrivate FROM users WHERE userName = %s AND password = %s"
-            cursor.execute(query, (username, password))
-            user = cursor.fetchone()
+                query = "SELECT UUID, userName, accountType, isPrivate, parentAccount FROM users WHERE userName = %s AND password = %s"
+                cursor.execute(query, (username, password))
+                user = cursor.fetchone()
+                if user:
+                    user = accounts.put(user, password)
 
-            if user:
-                return jsonify({
-                    "success": True, 
-                    "uuid": user["UUID"], 
-                    "accountType": user["accountType"], 
-                    "username": user["userName"],
-                    "isPrivate": user["isPrivate"]
-                }), 200
-            else:
-                return jsonify({"success": False, "error": "Invalid username or password"}), 400
+            except Exception as e:
 
-        except Exception as e:
-            return jsonify({"success": False, "error": "something failed while logging in"}), 500
-        
-        finally:
-            cursor.close()
-            conn.close()
+                logger.exception(e)
+                return jsonify({"success": False, "error": "something failed while logging in"}), 500
+
+            finally:
+                cursor.close()
+                conn.close()
+
+        if user:
+            return jsonify({
+                "success": True, 
+                "uuid": user["UUID"], 
+                "accountType": user["accountType"], 
+                "username": user["userName"],
+                "isPrivate": user["isPrivate"]
+            }), 200
+        else:
+            return jsonify({"success": False, "error": "Invalid username or password"}), 400
 
 
     # The route for creating new accounts
@@ -109,9 +3276,7 @@ def create_app(test_config=None):
             conn = connect_to_db()
             cursor = conn.cursor()
             
-            query = "SELECT UUID FROM users WHERE userName = %s"
-            cursor.execute(query, (username))
-            user = cursor.fetchone()
+            user = resolve_account(cursor, username)
             
             # Create new user if name is available
             if user:
@@ -121,10 +3286,19 @@ def create_app(test_config=None):
 
                 cursor.execute(query, (username, password, isPrivate, accountType))
                 conn.commit()
+                accounts.forget(username)
+
+                # groups go straight into the membership graph
+                if accountType != "1":
+                    created = resolve_account(cursor, username)
+                    if created:
+                        membership.add_account(created["UUID"], username)
 
                 return jsonify({"success": True, "username": username}), 201
             
         except Exception as e:
+            
+            logger.exception(e)
             return jsonify({"success": False, "error": "Unable to create account"}), 500
         
         finally:
@@ -146,9 +3320,7 @@ def create_app(test_config=None):
             conn = connect_to_db()
             cursor = conn.cursor()
             
-            query = "SELECT UUID FROM users WHERE userName = %s"
-            cursor.execute(query, (username))
-            user = cursor.fetchone()
+            user = resolve_account(cursor, username)
             
             # Create new user if name is available
             if user:
@@ -157,11 +3329,14 @@ def create_app(test_config=None):
                 query = "INSERT INTO users (UUID, userName, password, isPrivate, accountType, parentAccount) VALUES (NULL, %s, %s, %s, %s, %s)"
                 cursor.execute(query, (username, password, isPrivate, accountType, parentAccount))
                 conn.commit()
+                accounts.forget(username)
+                membership.add_account(cursor.lastrowid, username, parentAccount)
+                versions.bump("groups", parentAccount)
 
                 return jsonify({"success": True, "username": username}), 201
             
         except Exception as e:
-            print(e)
+            logger.exception(e)
             return jsonify({"success": False, "error": "Unable to create subAccount"}), 500
         
         finally:
@@ -181,23 +3356,25 @@ def create_app(test_config=None):
             cursor = conn.cursor()
 
             # Get Username
-            query = "SELECT UUID FROM users WHERE userName = %s"
-            cursor.execute(query, (userBeingInvited))
-            user = cursor.fetchone()['UUID']
+            user = resolve_account(cursor, userBeingInvited)
         
             if not user:
                 return jsonify({"success": False, "error": "User does not exist"}), 400
+            user = user['UUID']
 
             # Create new entry in groups table with pending set to TRUE
             query = "INSERT INTO userGroups (groupID, userID, pending) VALUES (%s, %s, TRUE)"
             cursor.execute(query, (groupDoingInviting, user))
             
             conn.commit()
+            membership.invite(user, groupDoingInviting)
+            versions.bump("invites", user)
+            bus.publish("invited", {"type": "invited", "group": groupDoingInviting}, [user])
             return jsonify({"success": True, "message": "Invited user"}), 200
 
 
         except Exception as e:
-            print(e)
+            logger.exception(e)
             return jsonify({"success": False, "error": "Unable to send invite"}), 500
         
         finally:
@@ -205,6 +3382,84 @@ def create_app(test_config=None):
             conn.close()
 
 
+    # Route for inviting a list of accounts to a group in one go
+    @app.route('/batchInviteAccount', methods=['POST'])
+    def batchInviteAccount():
+        response = request.get_json()
+
+        usersBeingInvited = response.get('invitedUsers') or []
+        groupDoingInviting = response.get('UUID')
+        if len(usersBeingInvited) > BATCH_MAX:
+            return jsonify({"success": False, "error": "At most " + str(BATCH_MAX) + " users per batch"}), 400
+
+        try:
+            conn = connect_to_db()
+            cursor = conn.cursor()
+
+            # Resolve the names from memory, the rest at once
+            found = {}
+            names = []
+            for name in set(usersBeingInvited):
+                account = accounts.get(name)
+                if account is not None:
+                    found[name] = account["UUID"]
+                else:
+                    names.append(name)
+            if names:
+                query = "SELECT UUID, userName, accountType, isPrivate, parentAccount FROM users WHERE userName IN (" + placeholders(names) + ")"
+                cursor.execute(query, names)
+                byKey = {AccountCache.key(name): name for name in names}
+                for row in cursor.fetchall():
+                    accounts.put(row)
+                    name = byKey.get(AccountCache.key(row["userName"]))
+                    if name is not None:
+                        found[name] = row["UUID"]
+
+            # Users already invited to (or in) the group have their row
+            existing = set()
+            uuids = sorted(set(found.values()))
+            if uuids:
+                query = "SELECT userID FROM userGroups WHERE groupID = %s AND userID IN (" + placeholders(uuids) + ")"
+                cursor.execute(query, [groupDoingInviting] + uuids)
+                existing = set(row["userID"] for row in cursor.fetchall())
+
+            results = []
+            invites = []
+            for name in usersBeingInvited:
+                if name not in found:
+                    results.append({"invitedUser": name, "success": False, "error": "User does not exist"})
+                elif found[name] in existing:
+                    results.append({"invitedUser": name, "success": False, "error": "Already invited or a member"})
+                elif (groupDoingInviting, found[name]) in invites:
+                    results.append({"invitedUser": name, "success": False, "error": "Listed more than once"})
+                else:
+                    invites.append((groupDoingInviting, found[name]))
+                    results.append({"invitedUser": name, "success": True})
+
+            # Create all the pending entries in one statement, a row added
+            # since the check above is left alone rather than failing them all
+            if invites:
+                query = "INSERT IGNORE INTO userGroups (groupID, userID, pending) VALUES (%s, %s, TRUE)"
+                cursor.executemany(query, invites)
+                if cursor.rowcount < len(invites):
+                    logger.warning("%d invites to %s already existed", len(invites) - cursor.rowcount, groupDoingInviting)
+            conn.commit()
+            for group, user in invites:
+                membership.invite(user, group)
+            versions.bump("invites", *set(user for _, user in invites))
+            for group, user in invites:
+                bus.publish("invited", {"type": "invited", "group": group}, [user])
+            return jsonify({"success": True, "results": results}), 200
+
+        except Exception as e:
+            logger.exception(e)
+            return jsonify({"success": False, "error": "Unable to send invites"}), 500
+
+        finally:
+            cursor.close()
+            conn.close()
+
+
     # Route for accepting or rejecting invites from a group
     @app.route('/inviteResponse', methods=['POST'])
     def inviteResponse():
@@ -219,26 +3474,40 @@ def create_app(test_config=None):
             cursor = conn.cursor()
 
             # Get UUID from userName
-            query = "SELECT UUID FROM users WHERE userName = %s"
-            cursor.execute(query, groupName)
-            group = cursor.fetchone()["UUID"]
+            group = resolve_account(cursor, groupName)["UUID"]
             
             if accept:
-                query = "UPDATE userGroups SET pending = FALSE WHERE userID = %s AND groupID = %s"
-                cursor.execute(query, (user, group))
+                # only an invite that exists (and is still pending) can be
+                # accepted, anything else would let users join any group
+                query = "UPDATE userGroups SET pending = FALSE WHERE userID = %s AND groupID = %s AND pending = TRUE"
+                if not cursor.execute(query, (user, group)):
+                    conn.rollback()
+                    return jsonify({"success": False, "error": "No pending invite from that group"}), 400
                 conn.commit()
+                membership.join(user, group)
+                feed_cache.invalidate_user(user)
+                versions.bump("invites", user)
+                versions.bump("groups", user)
+                bus.publish("inviteAnswered", {"type": "inviteAnswered", "UUID": user, "group": group, "accepted": True}, [user, group])
                 
                 return jsonify({"success": True, "message": "Successfully accepted invite"}), 200
             
             else:
                 query = "DELETE FROM userGroups WHERE userID = %s AND groupID = %s"
-                cursor.execute(query, (user, group))
+                if not cursor.execute(query, (user, group)):
+                    conn.rollback()
+                    return jsonify({"success": False, "error": "No invite from that group"}), 400
                 conn.commit()
+                membership.leave(user, group)
+                feed_cache.invalidate_user(user)
+                versions.bump("invites", user)
+                versions.bump("groups", user)
+                bus.publish("inviteAnswered", {"type": "inviteAnswered", "UUID": user, "group": group, "accepted": False}, [user, group])
                 
                 return jsonify({"success": True, "message": "Successfully rejected invite"}), 200
 
         except Exception as e:
-            print(e)
+            logger.exception(e)
             return jsonify({"success": False, "error": "Something went wrong trying to accept/deny invite"}), 500
 
         finally:
@@ -259,10 +3528,8 @@ def create_app(test_config=None):
             cursor = conn.cursor()
 
             # Get group info and check if it exists
-            query = "SELECT isPrivate, UUID FROM users WHERE userName = %s AND accountType != 1"
-            cursor.execute(query, groupToJoin)
-            groupInfo = cursor.fetchone()
-            if groupInfo is None:
+            groupInfo = resolve_account(cursor, groupToJoin)
+            if groupInfo is None or str(groupInfo["accountType"]) == "1":
                 return jsonify({"success": False, "error": "Entered account name does not exits"}), 400
             
             # Check if account is private
@@ -272,12 +3539,15 @@ def create_app(test_config=None):
             
             query = "CALL addUserToGroup(%s, %s)"
             cursor.execute(query, (userID, groupInfo["UUID"]))
-            print("UserID: %s\nGroupID: ",(userID, groupInfo["UUID"]))
+            logger.debug("UserID: %s GroupID: %s", userID, groupInfo["UUID"])
             conn.commit()
+            membership.join(userID, groupInfo["UUID"])
+            feed_cache.invalidate_user(userID)
+            versions.bump("groups", userID)
             return jsonify({"success": True}), 200
         
         except Exception as e:
-            print(e)
+            logger.exception(e)
             return jsonify({"success": False, "error": "Something went wrong trying to join a group"}), 500
 
         finally:
@@ -288,25 +3558,29 @@ def create_app(test_config=None):
     @app.route('/getInvitedList', methods=['GET'])
     def getInvitedList():
         user = request.args.get('UUID')
+        try:
+            limit, after = page_args()
+        except BadCursor as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+
+        unchanged = not_modified()
+        if unchanged is not None:
+            return unchanged
+        since = versions.seq()
 
         try:
-            conn = connect_to_db()
-            cursor = conn.cursor()
+            membership.ensure_loaded(load_memberships)
+            page, nxt = group_page(membership.invites(user), limit, after)
+            groupNames = group_names(page)
 
-            query = "SELECT userName FROM users WHERE UUID IN (SELECT groupID FROM userGroups WHERE userID = %s AND pending = TRUE)"
-            groupNames = cursor.execute(query, (user))
-            groupNames = cursor.fetchall()
-            groupNames = [x["userName"] for x in groupNames]
-            
-            return jsonify({"success": True, "groups": groupNames}), 200
+            payload = {"success": True, "groups": groupNames}
+            if limit is not None:
+                payload["next"] = nxt
+            return tagged(jsonify(payload), [("invites", user), ("membership", "all")], since), 200
 
         except Exception as e:
-            print(e)
+            logger.exception(e)
             return jsonify({"success": False, "error": "Something went wrong trying to get the invite list"}), 500
-
-        finally:
-            cursor.close()
-            conn.close()
         
 
     @app.route('/setPrivate', methods=['PUT'])
@@ -315,72 +3589,147 @@ def create_app(test_config=None):
         uuid = data.get('UUID')
         bit = data.get('isPrivate')
 
-        try:
-            conn = connect_to_db()
-            cursor = conn.cursor()
-
+        def write(cursor):
             cursor.execute('UPDATE users SET isPrivate = %s WHERE UUID = %s', (bit, uuid))
 
-            conn.commit()
+        try:
+            # forgotten again once written, a lookup in between would have
+            # cached the old value
+            accounts.forget(uuid=uuid)
+            run_write(("private", str(uuid)), write, lambda: accounts.forget(uuid=uuid))
             return '', 200
         except Exception as e:
+            logger.exception(e)
             return '', 500
-        finally:
-            cursor.close()
-            conn.close()
 
 
     @app.route('/createEvent', methods=['POST'])
     def createEvent():
-        load_dotenv()
         response = request.get_json()
         UUID = response.get('UUID')
-        eventName = response.get('eventName')
         address = response.get('address')
-        desc = response.get('desc')
-        cap = response.get('cap')
-        tags = response.get('tags')
-        date = response.get('date')
-
-        url = 'https://maps.googleapis.com/maps/api/geocode/json'
-        params = {
-            'address': address,
-            'key': os.getenv("geo_coding_key")
-        }
-        response = requests.get(url, params=params)
-        data = response.json()
+        deferred = response.get('deferred', os.getenv("geo_coding_deferred") == "1")
 
-        if data['status'] != 'OK':
-            return jsonify({'error': 'Geocoding failed', 'details': data.get('status')}), 500
+        lat = lng = None
+        if not deferred:
+            try:
+                lat, lng = geocoder.geocode(address)
+            except GeocodeError as e:
+                return jsonify({'error': 'Geocoding failed', 'details': e.status}), 500
 
-        location = data['results'][0]['geometry']['location']
+        try:
+            conn = connect_to_db()
+            cursor = conn.cursor()
+            cursor.execute(INSERT_EVENT_Q, event_values(UUID, response, lat, lng))
+            UEID = cursor.lastrowid
+            cursor.execute("INSERT INTO signUpCounts (UEID, signUps) VALUES (%s, 0)", (UEID,))
+            conn.commit()
+
+            if deferred:
+                geocoder.defer(UEID, address)
+                versions.bump("user", UUID)
+                return jsonify({"success": True, "UEID": UEID, "pending": True}), 202
+
+            event_created(cursor, UEID)
+            return jsonify({"success": True, "UEID": UEID}), 200
+        except Exception as e:
+            logger.exception(e)
+            return jsonify({"error": str(e)}), 500
+        finally:
+            cursor.close()
+            conn.close()
+
+    @app.route('/batchCreateEvent', methods=['POST'])
+    def batchCreateEvent():
+        response = request.get_json()
+        UUID = response.get('UUID')
+        events = response.get('events') or []
+        deferred = response.get('deferred', os.getenv("geo_coding_deferred") == "1")
+        if len(events) > BATCH_MAX:
+            return jsonify({"error": "At most " + str(BATCH_MAX) + " events per batch"}), 400
+
+        # Geocode each distinct address once
+        locations = {}
+        if not deferred:
+            for event in events:
+                address = normalize_address(event.get('address'))
+                if address in locations:
+                    continue
+                try:
+                    locations[address] = geocoder.geocode(event.get('address'))
+                except GeocodeError as e:
+                    locations[address] = e
 
         try:
             conn = connect_to_db()
             cursor = conn.cursor()
-            query = """
-                INSERT INTO events VALUES (NULL, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                (SELECT isPrivate FROM users WHERE UUID = %s))
-                """
-            cursor.execute(query, (
-                UUID, 
-                eventName, 
-                date, 
-                address, 
-                round(location['lat'], 3), 
-                round(location['lng'], 3), 
-                desc, 
-                tags, 
-                cap,
-                hashC(location['lat']),
-                hashC(location['lng']),
-                UUID
+
+            cursor.execute("SELECT isPrivate FROM users WHERE UUID = %s", (UUID,))
+            host = cursor.fetchone()
+            if host is None:
+                return jsonify({"error": "Host does not exist"}), 400
+
+            results = []
+            rows = []
+            for i, event in enumerate(events):
+                lat = lng = None
+                if not deferred:
+                    location = locations[normalize_address(event.get('address'))]
+                    if isinstance(location, GeocodeError):
+                        results.append({"index": i, "success": False, "error": "Geocoding failed", "details": location.status})
+                        continue
+                    lat, lng = location
+                rows.append((
+                    None,
+                    UUID,
+                    event.get('eventName'),
+                    event.get('date'),
+                    event.get('address'),
+                    round(lat, 3) if lat is not None else None,
+                    round(lng, 3) if lng is not None else None,
+                    event.get('desc'),
+                    event.get('tags'),
+                    event.get('cap'),
+                    hashC(lat) if lat is not None else None,
+                    hashC(lng) if lng is not None else None,
+                    host["isPrivate"]
                 ))
-            conn.commit()
-            return jsonify({"success": True}), 200
+                results.append({"index": i, "success": True})
+
+            if rows:
+                # multi-row INSERTs we split ourselves, InnoDB hands each
+                # simple insert a run of ids from its lastrowid, spaced by
+                # auto_increment_increment
+                cursor.execute("SELECT @@auto_increment_increment AS step")
+                step = cursor.fetchone()["step"]
+                template = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+                ueids = []
+                for chunk in value_chunks(cursor, template, rows):
+                    cursor.execute("INSERT INTO events VALUES " + ", ".join(chunk), name="INSERT INTO events VALUES (...)")
+                    ueids.extend(range(cursor.lastrowid, cursor.lastrowid + len(chunk) * step, step))
+                cursor.executemany("INSERT INTO signUpCounts (UEID, signUps) VALUES (%s, %s)",
+                                   [(ueid, 0) for ueid in ueids])
+                conn.commit()
+
+                created = iter(ueids)
+                for result in results:
+                    if result["success"]:
+                        result["UEID"] = next(created)
+
+                if deferred:
+                    for ueid, row in zip(ueids, rows):
+                        geocoder.defer(ueid, row[4])
+                    versions.bump("user", UUID)
+                else:
+                    events_created(cursor, ueids)
+
+            return jsonify({"success": True, "results": results}), 202 if deferred else 200
         except Exception as e:
-            print(e)
+            logger.exception(e)
             return jsonify({"error": str(e)}), 500
+        finally:
+            cursor.close()
+            conn.close()
 
     @app.route('/getCurrentGroups', methods=['GET'])
     def getCurrentGroups():
@@ -390,36 +3739,28 @@ def create_app(test_config=None):
             return jsonify({"success": False, "error": "Missing UUID"}), 400
 
         try:
-            conn = connect_to_db()
-            cursor = conn.cursor()
+            limit, after = page_args()
+        except BadCursor as e:
+            return jsonify({"success": False, "error": str(e)}), 400
 
-            query = """
-                SELECT userName
-                FROM users
-                WHERE UUID IN (
-                    SELECT groupID
-                    FROM userGroups
-                    WHERE userID = %s AND pending = FALSE
-                )
-            """
-            cursor.execute(query, (uuid,))
-            rows = cursor.fetchall()
+        unchanged = not_modified()
+        if unchanged is not None:
+            return unchanged
+        since = versions.seq()
 
-            group_string = ""
-            for row in rows:
-                group_string += row["userName"] + ", "
-            if group_string.endswith(", "):
-                group_string = group_string[:-2]
+        try:
+            membership.ensure_loaded(load_memberships)
+            page, nxt = group_page(membership.groups(uuid), limit, after)
+            group_string = ", ".join(group_names(page))
 
-            return jsonify({"success": True, "groups": group_string}), 200
+            payload = {"success": True, "groups": group_string}
+            if limit is not None:
+                payload["next"] = nxt
+            return tagged(jsonify(payload), [("groups", uuid), ("membership", "all")], since), 200
 
         except Exception as e:
-            print("Error: ", e)
+            logger.exception("Error: %s", e)
             return jsonify({"success": False, "error": "Failed to get groups"}), 500
-
-        finally:
-            cursor.close()
-            conn.close()
     
     @app.route('/updatePreferences', methods=['POST'])
     def updatePreferences():
@@ -427,71 +3768,103 @@ def create_app(test_config=None):
         uuid = data.get("UUID")
         prefs = data.get("pref")
         
-        try:
-            conn = connect_to_db()
-            cursor = conn.cursor()
-
+        def write(cursor):
             query = "CALL updatePreferences(%s, %s)"
             cursor.execute(query, (uuid, prefs))
 
+        # once committed, a read before then may have cached the old row
+        def done():
+            profiles.update(uuid, prefs=prefs)
+            feed_cache.invalidate_user(uuid)
+            versions.bump("prefs", uuid)
+
+        try:
+            run_write(("prefs", str(uuid)), write, done)
+
             return jsonify({"success": True, "prefs": prefs}), 200
 
         except Exception as e:
-            print(e)
+            logger.exception(e)
             return jsonify({"success": False, "error": "Failed to update preferences"}), 500
-        finally:
-            cursor.close()
-            conn.close()
 
 
     @app.route('/getPrefs', methods=['GET'])
     def getPrefs():
         uuid = request.args.get('UUID')
+        unchanged = not_modified()
+        if unchanged is not None:
+            return unchanged
+        since = versions.seq()
         
         try:
-            conn = connect_to_db()
-            cursor = conn.cursor()
-
-            query = "SELECT prefs FROM prefs WHERE UUID = %s"
-            cursor.execute(query, (uuid))
-            data = cursor.fetchall()
-
-            return jsonify({"success": True, "prefs":data[0]["prefs"]}), 200
+            profile = get_profile(uuid)
+            return tagged(jsonify({"success": True, "prefs": profile["prefs"]}), [("prefs", uuid)], since), 200
 
         except Exception as e:
-            print(e)
+            logger.exception(e)
             return jsonify({"success": False, "error": "Failed to get preferences"}), 500
-        finally:
-            cursor.close()
-            conn.close()
     
     @app.route("/getUserEvents", methods=['GET'])
     def getUserEvents():
         UUID = request.args.get('UUID')
+        try:
+            limit, after = page_args()
+        except BadCursor as e:
+            return jsonify({'error': str(e)}), 400
+
+        query = USER_EVENTS_Q
+        params = [UUID, UUID, UUID]
+        if after is not None:
+            hosting, date, ueid = after
+            query += USER_EVENTS_AFTER_Q
+            params += [UUID, hosting, UUID, hosting, date, date, ueid]
+        query += USER_EVENTS_ORDER_Q
+        if limit is not None:
+            query += " LIMIT %s"
+            params.append(limit)
+
+        def next_cursor(event):
+            return encode_cursor(event["hosting"], event["date"], event["UEID"])
+
+        if wants_stream():
+            def split(event):
+                hosting = event["hosting"]
+                item = with_remaining({k: v for k, v in event.items() if k != "hosting"})
+                return ("hostingEvents" if hosting else "attendingEvents"), item
+            return stream_json(query, params, split, ["hostingEvents", "attendingEvents"],
+                               limit=limit, next_cursor=next_cursor)
+
+        unchanged = not_modified()
+        if unchanged is not None:
+            return unchanged
+        since = versions.seq()
+
         try:
             conn = connect_to_db()
             cursor = conn.cursor()
-            # TODO get list of events user is hosting
-            hostedQ = "SELECT * FROM events WHERE eventHost = %s AND date >= NOW()"
-            cursor.execute(hostedQ, (UUID,))
-            hostingEvents = cursor.fetchall()
-            # TODO get list of events user is signed up for
-            attendingQ = """
-                    SELECT e.*, u.userName AS hostName FROM events e
-                    JOIN users u on e.eventHost = u.UUID WHERE UEID IN (
-                    SELECT UEID FROM signedUp WHERE UUID = %s
-                    )
-                    AND e.eventHost != %s
-                    AND e.date >= NOW()
-                """
-            cursor.execute(attendingQ, (UUID, UUID))
-            attendingEvents = cursor.fetchall()
-            return jsonify({
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            more = limit is not None and len(rows) == limit
+            nxt = next_cursor(rows[-1]) if more else None
+
+            hostingEvents = []
+            attendingEvents = []
+            for event in rows:
+                hosting = event.pop("hosting")
+                (hostingEvents if hosting else attendingEvents).append(with_remaining(event))
+            payload = {
                 "hostingEvents": hostingEvents,
                 "attendingEvents": attendingEvents
-            }), 200
+            }
+            if limit is not None:
+                payload["next"] = nxt
+            # the list changes when the user signs up or hosts, when one of
+            # its events changes, or when the first of them is over
+            keys = [("user", UUID)] + [("event", event["UEID"]) for event in rows]
+            expiry = min((expires_at(event) for event in rows if expires_at(event) is not None), default=None)
+            return tagged(jsonify(payload), keys, since, expiry), 200
         except Exception as e:
-            print(e)
+            logger.exception(e)
             return jsonify({'error': str(e)}), 500
         finally:
             cursor.close()
@@ -502,42 +3875,71 @@ def create_app(test_config=None):
         data = request.get_json()
         uuid = data.get("UUID")
         dist = data.get("dist")
+        if dist is not None:
+            # the column is an INT, store and hand back what it will hold
+            try:
+                dist = int(round(float(dist)))
+            except (TypeError, ValueError):
+                return jsonify({"success": False, "error": "Invalid dist"}), 400
 
-        try:
-            conn = connect_to_db()
-            cursor = conn.cursor()
-
+        def write(cursor):
             query = "CALL updateDistance(%s, %s)"
             cursor.execute(query, (uuid, dist))
+
+        # once committed, a read before then may have cached the old row
+        def done():
+            profiles.update(uuid, dist=dist)
+            feed_cache.invalidate_user(uuid)
+            versions.bump("prefs", uuid)
+
+        try:
+            run_write(("dist", str(uuid)), write, done)
             return jsonify({"success": True, "dist": dist}), 200
             
         except Exception as e:
-            print(e)
+            logger.exception(e)
             return jsonify({"success": False, "error": "Failed to update preferred distance"}), 500
-        finally:
-            cursor.close()
-            conn.close()
 
 
     @app.route('/getDistance', methods=['GET'])
     def getDistance():
         uuid = request.args.get("UUID")
+        unchanged = not_modified()
+        if unchanged is not None:
+            return unchanged
+        since = versions.seq()
         
         try:
-            conn = connect_to_db()
-            cursor = conn.cursor()
-
-            query = "SELECT dist FROM prefs WHERE UUID = %s"
-            cursor.execute(query, (uuid))
-            dist = cursor.fetchall()
-            return jsonify({"success": True, "distance": dist[0]["dist"]}), 200
+            profile = get_profile(uuid)
+            return tagged(jsonify({"success": True, "distance": profile["dist"]}), [("prefs", uuid)], since), 200
             
         except Exception as e:
-            print(e)
+            logger.exception(e)
             return jsonify({"success": False, "error": "Failed to update preferences"}), 500
-        finally:
-            cursor.close()
-            conn.close()
+
+    # The whole profile (prefs and distance) in one call
+    @app.route('/getProfile', methods=['GET'])
+    def getProfile():
+        uuid = request.args.get("UUID")
+        unchanged = not_modified()
+        if unchanged is not None:
+            return unchanged
+        since = versions.seq()
+
+        try:
+            profile = get_profile(uuid)
+            if profile is None:
+                return jsonify({"success": False, "error": "No profile for this user"}), 404
+            return tagged(jsonify({
+                "success": True,
+                "prefs": profile["prefs"],
+                "tokens": sorted(profile["tokens"]),
+                "distance": profile["dist"]
+            }), [("prefs", uuid)], since), 200
+
+        except Exception as e:
+            logger.exception(e)
+            return jsonify({"success": False, "error": "Failed to get profile"}), 500
     
 
     @app.route('/getEventFeed', methods=["GET"])
@@ -546,67 +3948,42 @@ def create_app(test_config=None):
         long = float(request.args.get("long"))
         lat = float(request.args.get("lat"))
         try:
-            conn = connect_to_db()
-            cursor = conn.cursor()
+            limit, after = page_args()
+        except BadCursor as e:
+            return jsonify({'error': str(e)}), 400
 
-            # Get list of events from groups they are apart of
-            groupQ = """
-                SELECT e.*, u.userName AS hostName
-                FROM events e
-                JOIN users u ON e.eventHost = u.UUID
-                WHERE e.eventHost IN (
-                    SELECT ug.groupID
-                    FROM userGroups ug
-                    WHERE ug.userID = %s AND ug.pending = FALSE
-                    UNION
-                    SELECT u.parentAccount
-                    FROM users u
-                    JOIN userGroups ug ON ug.groupID = u.UUID
-                    WHERE ug.userID = %s AND ug.pending = FALSE AND u.parentAccount IS NOT NULL
-                )
-                AND e.date >= NOW()
-            """
-            cursor.execute(groupQ, (UUID, UUID))
-            groupEvents = cursor.fetchall()
-
-            # Get list of public events within distance
-            publicQ = "CALL findEvents(%s, %s, %s)"
-            cursor.execute(publicQ, (UUID, hashC(lat), hashC(long)))
-            publicEvents = cursor.fetchall()
-            publicEvents = publicEvents
-            while cursor.nextset():
-                pass
-            
-            # Filter feed for events that share tags
-            query = "SELECT prefs FROM prefs WHERE UUID = %s"
-            cursor.execute(query, (UUID))
-            prefs = cursor.fetchall()
-            prefs = prefs[0]["prefs"].lower().split()
-            print("Prefs: ", prefs)
-
-            # Count the number of shared tags
-            matching = []
-            if (len(prefs) == 0):
-                matching = publicEvents
-            else:
-                for event in publicEvents:
-                    print(event["tags"])
-                    event["tags"] = event["tags"].lower()
-                    for p in prefs:
-                        if p in event["tags"]:
-                            matching.append(event)
-                            break
+        def respond(feed):
+            if limit is None:
+                return jsonify(feed), 200
+            try:
+                return jsonify(feed_page(feed, limit, after)), 200
+            except BadCursor as e:
+                return jsonify({'error': str(e)}), 400
 
-            return jsonify({
-                "groupEvents": groupEvents,
-                "eventFeed": matching
-            }), 200
+        key = FeedCache.key(UUID, lat, long)
+        cached = feed_cache.get(key)
+        if cached is not None:
+            return respond(cached)
+
+        try:
+            start = time.perf_counter()
+
+            # The group events, the users prefs (and how far they are willing
+            # to go) and the public index don't depend on each other, so they
+            # are fetched side by side on their own pooled connections
+            groupF = feed_executor.submit(feed_timings.timed, "groupEvents", fetch_group_events, UUID)
+            profileF = feed_executor.submit(feed_timings.timed, "prefs", get_profile, UUID)
+            indexF = feed_executor.submit(feed_timings.timed, "publicIndex", event_grid.ensure_loaded, load_public_events)
+            groupEvents = groupF.result()
+            profile = profileF.result() or ProfileStore.make("", None)
+            indexF.result()
+
+            feed = feed_timings.timed("assemble", assemble_feed, key, lat, long, groupEvents, profile)
+            feed_timings.record("total", time.perf_counter() - start)
+            return respond(feed)
         except Exception as e:
-            print(e)
+            logger.exception(e)
             return jsonify({'error': str(e)}), 500
-        finally:
-            cursor.close()
-            conn.close()
 
     @app.route('/deleteEvent', methods=["GET"])
     def deleteEvent():
@@ -614,13 +3991,24 @@ def create_app(test_config=None):
         try:
             conn = connect_to_db()
             cursor = conn.cursor()
+            # who to tell, before the rows are gone
+            cursor.execute("SELECT eventHost, lat, `long`, isPrivate FROM events WHERE UEID = %s", (UEID,))
+            event = cursor.fetchone()
+            cursor.execute("SELECT UUID FROM signedUp WHERE UEID = %s", (UEID,))
+            attendees = [row["UUID"] for row in cursor.fetchall()]
+
             deleteQSignedUp = "DELETE FROM signedUp WHERE UEID = %s"
             cursor.execute(deleteQSignedUp, (UEID,))
+            cursor.execute("DELETE FROM signUpCounts WHERE UEID = %s", (UEID,))
             deleteQEvents = "DELETE FROM events WHERE UEID = %s"
             cursor.execute (deleteQEvents, (UEID,))
             conn.commit()
+            event_deleted(int(UEID))
+            if event is not None:
+                publish_event("eventDeleted", event, {"type": "eventDeleted", "UEID": int(UEID)}, attendees)
             return jsonify({"status": "all good :3"}), 200
         except Exception as e:
+            logger.exception(e)
             return jsonify({'error': str(e)}), 500
         finally:
             cursor.close()
@@ -630,49 +4018,154 @@ def create_app(test_config=None):
     def unSignUpEvent():
         UEID = request.args.get("UEID")
         UUID = request.args.get("UUID")
-        try:
-            conn = connect_to_db()
-            cursor = conn.cursor()
+        def write(cursor):
             deleteQSignedUp = "DELETE FROM signedUp WHERE UUID = %s and UEID = %s"
-            cursor.execute(deleteQSignedUp, (UUID, UEID))
-            conn.commit()
+            if cursor.execute(deleteQSignedUp, (UUID, UEID)):
+                cursor.execute("UPDATE signUpCounts SET signUps = signUps - 1 WHERE UEID = %s", (UEID,))
+
+        def done():
+            versions.bump("event", UEID)
+            versions.bump("user", UUID)
+            publish_signup(UEID, UUID, -1)
+
+        try:
+            run_write(("unSignUp", str(UUID), str(UEID)), write, done)
             return jsonify({"status": "all good :3"}), 200
         except Exception as e:
+            logger.exception(e)
             return jsonify({'error': str(e)}), 500
-        finally:
-            cursor.close()
-            conn.close()
 
     @app.route('/signUp', methods=["GET"])
     def signUp():
         UEID = int(request.args.get("UEID"))
         UUID = int(request.args.get("UUID"))
-        cap = int(request.args.get("cap"))
 
         try:
+            write_behind.flush_key(("unSignUp", str(UUID), str(UEID)))
             conn = connect_to_db()
             cursor = conn.cursor()
 
-            checkUserQ = "SELECT * FROM signedUp WHERE UUID = %s AND UEID = %s"
-            cursor.execute(checkUserQ, (UUID, UEID))
+            # Taking a spot locks the event's counter row until commit, so
+            # concurrent signups for the same event line up behind it and the
+            # stored cap can't be overshot
+            for _ in range(2):
+                if cursor.execute(TAKE_SPOT_Q, (UEID,)):
+                    break
+                cursor.execute(SPOTS_Q, (UEID,))
+                event = cursor.fetchone()
+                if event is None:
+                    return jsonify({"error": "Event does not exist"}), 404
+                if event["signUps"] is None:
+                    # no counter yet, make one and try again
+                    cursor.execute("INSERT IGNORE INTO signUpCounts (UEID, signUps) VALUES (%s, 0)", (UEID,))
+                    continue
+                cursor.execute(CHECK_SIGNED_UP_Q, (UUID, UEID))
+                if cursor.fetchone():
+                    return jsonify({"error": "User already signed up for this event"}), 403
+                return jsonify({"error": "Event is at full capacity"}), 400
+            else:
+                # still no counter to take a spot from (this transaction's
+                # snapshot predates the one another request made), never
+                # sign up without one
+                conn.rollback()
+                return jsonify({"error": "Could not reserve a spot, try again"}), 409
+
+            cursor.execute(CHECK_SIGNED_UP_Q, (UUID, UEID))
             if cursor.fetchone():
+                conn.rollback()
                 return jsonify({"error": "User already signed up for this event"}), 403
 
-            countQ = "SELECT COUNT(*) FROM signedUp WHERE UEID = %s"
-            cursor.execute(countQ, (UEID,))
-            row = cursor.fetchone()
-            count = row['COUNT(*)']
-            if cap > 0 and count >= cap:
-                return jsonify({"error": "Event is at full capacity"}), 400
-
             insertQ = "INSERT INTO signedUp (UUID, UEID) VALUES (%s, %s)"
             cursor.execute(insertQ, (UUID, UEID))
             conn.commit()
+            versions.bump("event", UEID)
+            versions.bump("user", UUID)
+            publish_signup(UEID, UUID, 1)
 
             return jsonify({"status": "success"}), 200
 
         except Exception as e:
-            print("Error when signing up:", e)
+            logger.exception("Error when signing up: %s", e)
+            return jsonify({'error': str(e)}), 500
+
+        finally:
+            cursor.close()
+            conn.close()
+
+    @app.route('/batchSignUp', methods=["POST"])
+    def batchSignUp():
+        response = request.get_json()
+        signUps = response.get("signUps") or []
+        if len(signUps) > BATCH_MAX:
+            return jsonify({"error": "At most " + str(BATCH_MAX) + " signups per batch"}), 400
+
+        try:
+            pairs = [(int(item["UUID"]), int(item["UEID"])) for item in signUps]
+        except (KeyError, TypeError, ValueError):
+            return jsonify({"error": "Every signup needs a UUID and a UEID"}), 400
+        if not pairs:
+            return jsonify({"status": "success", "results": []}), 200
+
+        try:
+            for uuid, ueid in pairs:
+                write_behind.flush_key(("unSignUp", str(uuid), str(ueid)))
+            conn = connect_to_db()
+            cursor = conn.cursor()
+
+            ueids = sorted(set(ueid for _, ueid in pairs))
+            uuids = sorted(set(uuid for uuid, _ in pairs))
+
+            # Lock every counter involved straight away with exclusive locks
+            # taken in UEID order, then decide each item against those locked
+            # counts. createEvent and the 001 migration give every event its
+            # counter row, so nothing is inserted (or share-locked) first
+            query = """
+                SELECT c.UEID, c.signUps, e.cap
+                FROM signUpCounts c
+                JOIN events e ON e.UEID = c.UEID
+                WHERE c.UEID IN (""" + placeholders(ueids) + """)
+                ORDER BY c.UEID
+                FOR UPDATE
+            """
+            cursor.execute(query, ueids)
+            spots = {row["UEID"]: row for row in cursor.fetchall()}
+
+            query = ("SELECT UUID, UEID FROM signedUp WHERE UEID IN (" + placeholders(ueids)
+                     + ") AND UUID IN (" + placeholders(uuids) + ")")
+            cursor.execute(query, ueids + uuids)
+            taken = set((row["UUID"], row["UEID"]) for row in cursor.fetchall())
+
+            results = []
+            inserts = []
+            for uuid, ueid in pairs:
+                event = spots.get(ueid)
+                if event is None:
+                    results.append({"UUID": uuid, "UEID": ueid, "success": False, "error": "Event does not exist"})
+                elif (uuid, ueid) in taken:
+                    results.append({"UUID": uuid, "UEID": ueid, "success": False, "error": "User already signed up for this event"})
+                elif event["cap"] and event["cap"] > 0 and event["signUps"] >= event["cap"]:
+                    results.append({"UUID": uuid, "UEID": ueid, "success": False, "error": "Event is at full capacity"})
+                else:
+                    taken.add((uuid, ueid))
+                    event["signUps"] += 1
+                    inserts.append((uuid, ueid))
+                    results.append({"UUID": uuid, "UEID": ueid, "success": True})
+
+            if inserts:
+                cursor.executemany("INSERT INTO signedUp (UUID, UEID) VALUES (%s, %s)", inserts)
+                changed = set(ueid for _, ueid in inserts)
+                cursor.executemany("UPDATE signUpCounts SET signUps = %s WHERE UEID = %s",
+                                   [(spots[ueid]["signUps"], ueid) for ueid in changed])
+            conn.commit()
+            versions.bump("event", *set(ueid for _, ueid in inserts))
+            versions.bump("user", *set(uuid for uuid, _ in inserts))
+            for uuid, ueid in inserts:
+                publish_signup(ueid, uuid, 1)
+
+            return jsonify({"status": "success", "results": results}), 200
+
+        except Exception as e:
+            logger.exception("Error when signing up: %s", e)
             return jsonify({'error': str(e)}), 500
 
         finally:
@@ -682,26 +4175,97 @@ def create_app(test_config=None):
     @app.route('/getSingleEvent', methods=["GET"])
     def getSingleEvent():
         UEID = request.args.get("UEID")
+        unchanged = not_modified()
+        if unchanged is not None:
+            return unchanged
+        since = versions.seq()
 
         try:
             conn = connect_to_db()
             cursor = conn.cursor()
 
-            q = "select * from events where UEID = %s"
-            cursor.execute(q, (UEID))
+            cursor.execute(EVENT_DETAIL_Q, (UEID,))
             res = cursor.fetchone()
 
             if res:
-                return jsonify({"status": "event found", "event": res}), 200
+                with_remaining(res)
+                return tagged(jsonify({"status": "event found", "event": res}), [("event", UEID)], since), 200
             else:
-                return jsonify({"status": "no event found"}), 400
+                return tagged(jsonify({"status": "no event found"}), [("event", UEID)], since), 400
 
         except Exception as e:
-            print("Error when getting event:", e)
+            logger.exception("Error when getting event: %s", e)
             return jsonify({'error': str(e)}), 500
 
         finally:
             cursor.close()
             conn.close()
 
+    # Server-sent events for the user's events, signups and invites and for
+    # public events around (lat, long), instead of polling the feed. Resumes
+    # after Last-Event-ID when the bus still has it, otherwise sends a reset
+    @app.route('/subscribe', methods=["GET"])
+    def subscribe():
+        UUID = request.args.get("UUID")
+        if not UUID:
+            return jsonify({"error": "Missing UUID"}), 400
+        try:
+            lat = float(request.args["lat"]) if request.args.get("lat") else None
+            long = float(request.args["long"]) if request.args.get("long") else None
+            dist = request.args.get("dist")
+            if dist is None and lat is not None:
+                profile = get_profile(UUID)
+                dist = profile["dist"] if profile and profile["dist"] is not None else DEFAULT_DIST
+            dist = float(dist) if dist is not None else None
+            last_id = request.headers.get("Last-Event-ID") or request.args.get("lastEventId") or None
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        membership.ensure_loaded(load_memberships)
+        sub = bus.add(Subscription(UUID, lat, long, dist), last_id)
+
+        def generate():
+            try:
+                yield "retry: 3000\n\n"
+                while True:
+                    try:
+                        item = sub.queue.get(timeout=SSE_HEARTBEAT)
+                    except queue.Empty:
+                        yield ": keepalive\n\n"
+                        continue
+                    yield sse_frame(item)
+                    if item[1] == "reset":
+                        return
+            finally:
+                bus.remove(sub)
+
+        return Response(generate(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @app.route('/metrics', methods=["GET"])
+    def getMetrics():
+        payload = metrics.snapshot()
+        payload["success"] = True
+        payload["pool"] = get_pool().stats()
+        payload["profiles"] = list(metrics.profiles)
+        return jsonify(payload), 200
+
+    @app.route('/getStats', methods=["GET"])
+    def getStats():
+        return jsonify({
+            "success": True,
+            "pool": get_pool().stats(),
+            "feedCache": feed_cache.stats(),
+            "geocoder": geocoder.stats(),
+            "feedStages": feed_timings.stats(),
+            "profiles": profiles.stats(),
+            "snapshots": snapshots.stats(),
+            "archiver": archiver.stats(),
+            "etags": versions.stats(),
+            "accounts": accounts.stats(),
+            "writeBehind": write_behind.stats(),
+            "bus": bus.stats(),
+            "cluster": cluster.stats()
+        }), 200
+
     return app
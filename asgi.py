@@ -0,0 +1,384 @@
+# Async serving mode for the event API.
+#
+#   pip install -r requirements.txt -r requirements-asgi.txt
+#   uvicorn asgi:app --workers 1
+#
+# /getEventFeed and /createEvent are served natively on the event loop with
+# aiomysql and httpx, and /subscribe holds its server-sent events stream on
+# the loop instead of a thread. Everything else falls through to the regular
+# Flask app (run in a thread by asgiref), so every route keeps the same
+# payloads. The native routes record the same route latencies (/metrics)
+# and feed stage timings (/getStats) as the Flask ones.
+import asyncio
+import os
+import time
+from urllib.parse import parse_qs
+
+import aiomysql
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+
+from app import (
+    COMPRESS_MIN_BYTES, DEFAULT_DIST, HOSTED_EVENTS_Q, INSERT_EVENT_Q,
+    PROFILE_Q, PAGE_MAX, SSE_HEARTBEAT,
+    BadCursor, EventRecord, FeedCache, GeocodeError, Subscription, bus,
+    assemble_feed, compress_body, connect_to_db, create_app, decode_cursor,
+    encode_json, event_created, event_grid, event_values, feed_cache,
+    feed_page, feed_timings, geocoder, load_memberships, load_public_events,
+    logger, membership, metrics, normalize_address, pick_encoding,
+    placeholders, profiles, ProfileStore, sse_frame, versions, write_behind,
+)
+
+flask_app = create_app()
+wsgi = WsgiToAsgi(flask_app)
+
+# one aiomysql pool and one httpx client per event loop
+_pools = {}
+_pool_locks = {}
+_clients = {}
+
+
+async def get_pool():
+    # autocommit so reads don't leave connections mid-transaction, which
+    # aiomysql closes instead of putting back in the pool
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is not None:
+        return pool
+    async with _pool_locks.setdefault(loop, asyncio.Lock()):
+        pool = _pools.get(loop)
+        if pool is not None:
+            return pool
+        pool = await aiomysql.create_pool(
+            host=os.getenv("db_host"),
+            user=os.getenv("db_user"),
+            password=os.getenv("db_password"),
+            db=os.getenv("db_name"),
+            minsize=int(os.getenv("db_pool_min", 1)),
+            maxsize=int(os.getenv("db_pool_max", 10)),
+            pool_recycle=int(float(os.getenv("db_pool_lifetime", 3600))),
+            cursorclass=aiomysql.DictCursor,
+            autocommit=True,
+        )
+        _pools[loop] = pool
+        return pool
+
+
+def get_client():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(timeout=httpx.Timeout(
+            float(os.getenv("geo_coding_timeout", 5)),
+            connect=float(os.getenv("geo_coding_connect_timeout", 2)),
+        ))
+        _clients[loop] = client
+    return client
+
+
+async def fetchall(query, params):
+    # each call borrows its own connection so queries can run side by side
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(query, params)
+            return await cursor.fetchall()
+
+
+async def geocode(address):
+    # same cache and error handling as Geocoder.geocode, over httpx
+    normalized = normalize_address(address)
+    cached = await asyncio.to_thread(geocoder.cache.get, normalized)
+    if cached is None:
+        cached = await asyncio.to_thread(geocoder.lookup_shared, normalized)
+    if cached is not None:
+        return cached
+    try:
+        response = await get_client().get(geocoder.url, params={'address': address, 'key': geocoder.key})
+        data = response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        raise GeocodeError(type(e).__name__)
+    if data.get('status') != 'OK':
+        raise GeocodeError(data.get('status'))
+    location = data['results'][0]['geometry']['location']
+    await asyncio.to_thread(geocoder.cache.put, normalized, location['lat'], location['lng'])
+    await asyncio.to_thread(geocoder.store_shared, normalized, location['lat'], location['lng'])
+    return location['lat'], location['lng']
+
+
+async def group_events(UUID):
+    await asyncio.to_thread(membership.ensure_loaded, load_memberships)
+    hosts = sorted(membership.hosts_for(UUID))
+    if not hosts:
+        return []
+    rows = await fetchall(HOSTED_EVENTS_Q.format(placeholders(hosts)), hosts)
+    return [EventRecord(row) for row in rows]
+
+
+async def get_profile(UUID):
+    profile = profiles.get(UUID)
+    if profile is None:
+        rows = await fetchall(PROFILE_Q, (UUID,))
+        if rows:
+            profile = profiles.put(UUID, rows[0]["prefs"], rows[0]["dist"])
+    return profile
+
+
+def index_new_event(ueid):
+    conn = connect_to_db()
+    cursor = conn.cursor()
+    try:
+        event_created(cursor, ueid)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+async def timed(stage, awaitable):
+    # feed_timings.timed for a coroutine
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        feed_timings.record(stage, time.perf_counter() - start)
+
+
+async def event_feed(query, body):
+    UUID = query.get("UUID")
+    long = float(query.get("long"))
+    lat = float(query.get("lat"))
+    try:
+        limit = query.get("limit")
+        limit = max(1, min(int(limit), PAGE_MAX)) if limit is not None else None
+        after = decode_cursor(query["after"]) if query.get("after") else None
+    except (BadCursor, ValueError) as e:
+        return 400, {'error': str(e)}
+
+    def respond(feed):
+        if limit is None:
+            return 200, feed
+        try:
+            return 200, feed_page(feed, limit, after)
+        except BadCursor as e:
+            return 400, {'error': str(e)}
+
+    key = FeedCache.key(UUID, lat, long)
+    cached = feed_cache.get(key)
+    if cached is not None:
+        return respond(cached)
+
+    try:
+        start = time.perf_counter()
+        # the group events, prefs and (first time only) the public index
+        # load don't depend on each other
+        groupEvents, profile, _ = await asyncio.gather(
+            timed("groupEvents", group_events(UUID)),
+            timed("prefs", get_profile(UUID)),
+            timed("publicIndex", asyncio.to_thread(event_grid.ensure_loaded, load_public_events)),
+        )
+        profile = profile or ProfileStore.make("", None)
+        feed = feed_timings.timed("assemble", assemble_feed, key, lat, long, list(groupEvents), profile)
+        feed_timings.record("total", time.perf_counter() - start)
+        return respond(feed)
+    except Exception as e:
+        logger.exception(e)
+        return 500, {'error': str(e)}
+
+
+async def create_event(query, body):
+    UUID = body.get('UUID')
+    address = body.get('address')
+    deferred = body.get('deferred', os.getenv("geo_coding_deferred") == "1")
+
+    lat = lng = None
+    if not deferred:
+        try:
+            lat, lng = await geocode(address)
+        except GeocodeError as e:
+            return 500, {'error': 'Geocoding failed', 'details': e.status}
+
+    try:
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            # the event and its counter row go in together
+            await conn.begin()
+            try:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(INSERT_EVENT_Q, event_values(UUID, body, lat, lng))
+                    UEID = cursor.lastrowid
+                    await cursor.execute("INSERT INTO signUpCounts (UEID, signUps) VALUES (%s, 0)", (UEID,))
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+
+        if deferred:
+            geocoder.defer(UEID, address)
+            versions.bump("user", UUID)
+            return 202, {"success": True, "UEID": UEID, "pending": True}
+
+        await asyncio.to_thread(index_new_event, UEID)
+        return 200, {"success": True, "UEID": UEID}
+    except Exception as e:
+        logger.exception(e)
+        return 500, {"error": str(e)}
+
+
+class LoopSubscription(Subscription):
+    # hands bus messages (published from any thread) to an asyncio queue
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    def offer(self, item):
+        self.loop.call_soon_threadsafe(self._put, item)
+        return True
+
+    def _put(self, item):
+        if self.queue.qsize() >= self.max_queued:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait((item[0], "reset", "{}"))
+            bus.remove(self)
+            return
+        self.queue.put_nowait(item)
+
+
+async def subscribe(scope, receive, send):
+    # same stream as the Flask /subscribe route
+    query = {k: v[0] for k, v in parse_qs(scope["query_string"].decode()).items()}
+    headers = dict(scope["headers"])
+    UUID = query.get("UUID")
+    try:
+        if not UUID:
+            raise ValueError("Missing UUID")
+        lat = float(query["lat"]) if query.get("lat") else None
+        long = float(query["long"]) if query.get("long") else None
+        dist = query.get("dist")
+        if dist is None and lat is not None:
+            profile = await get_profile(UUID)
+            dist = profile["dist"] if profile and profile["dist"] is not None else DEFAULT_DIST
+        dist = float(dist) if dist is not None else None
+        last_id = headers.get(b"last-event-id", b"").decode() or query.get("lastEventId") or None
+    except ValueError as e:
+        data = encode_json({"error": str(e)}).encode()
+        await send({"type": "http.response.start", "status": 400,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode())]})
+        await send({"type": "http.response.body", "body": data})
+        return
+
+    await asyncio.to_thread(membership.ensure_loaded, load_memberships)
+    sub = bus.add(LoopSubscription(UUID, lat, long, dist), last_id)
+
+    async def disconnected():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    watcher = asyncio.ensure_future(disconnected())
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+                (b"access-control-allow-origin", b"*"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": b"retry: 3000\n\n", "more_body": True})
+        while not watcher.done():
+            getter = asyncio.ensure_future(sub.queue.get())
+            done, _ = await asyncio.wait({getter, watcher}, timeout=SSE_HEARTBEAT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if getter not in done:
+                getter.cancel()
+                if not watcher.done():
+                    await send({"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True})
+                continue
+            item = getter.result()
+            await send({"type": "http.response.body", "body": sse_frame(item).encode(), "more_body": True})
+            if item[1] == "reset":
+                break
+        if not watcher.done():
+            await send({"type": "http.response.body", "body": b""})
+    finally:
+        watcher.cancel()
+        bus.remove(sub)
+
+
+STREAMS = {
+    ("GET", "/subscribe"): subscribe,
+}
+
+ROUTES = {
+    ("GET", "/getEventFeed"): event_feed,
+    ("POST", "/createEvent"): create_event,
+}
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await asyncio.to_thread(write_behind.close)
+            for pool in list(_pools.values()):
+                pool.close()
+                await pool.wait_closed()
+            for client in list(_clients.values()):
+                await client.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    stream = STREAMS.get((scope.get("method"), scope.get("path")))
+    if scope["type"] == "http" and stream is not None:
+        return await stream(scope, receive, send)
+
+    handler = ROUTES.get((scope.get("method"), scope.get("path")))
+    if scope["type"] != "http" or handler is None:
+        return await wsgi(scope, receive, send)
+
+    query = {k: v[0] for k, v in parse_qs(scope["query_string"].decode()).items()}
+    raw = await read_body(receive)
+    body = flask_app.json.loads(raw) if raw else {}
+
+    start = time.perf_counter()
+    status, payload = await handler(query, body)
+    metrics.observe("routes", scope["method"] + " " + scope["path"], time.perf_counter() - start)
+    data = (encode_json(payload) + "\n").encode()
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"access-control-allow-origin", b"*"),
+    ]
+    # same negotiation as the Flask compress_response hook
+    if os.getenv("compress_responses", "1") == "1" and len(data) >= COMPRESS_MIN_BYTES:
+        headers.append((b"vary", b"Accept-Encoding"))
+        accept = dict(scope["headers"]).get(b"accept-encoding", b"").decode("latin-1")
+        encoding = pick_encoding(accept)
+        if encoding is not None:
+            data = compress_body(data, encoding)
+            headers.append((b"content-encoding", encoding.encode()))
+    headers.append((b"content-length", str(len(data)).encode()))
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": headers,
+    })
+    await send({"type": "http.response.body", "body": data})
@@ -0,0 +1,682 @@
+import argparse
+import collections
+import datetime
+import decimal
+import gzip
+import glob
+import hashlib
+import json
+import os
+import queue
+import random
+import socketserver
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from werkzeug.serving import make_server
+
+import app
+
+SQL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql")
+TAGS = [
+    "music", "sports", "outdoors", "food", "art", "tech", "games", "books",
+    "film", "dance", "hiking", "volunteer", "coffee", "yoga", "trivia", "market",
+]
+STREETS = ["Main St", "Colfax Ave", "Broadway", "Oak St", "Pine St", "Elm St", "Park Ave", "Lake Dr"]
+
+
+def timed(fn, repeat):
+    # best of repeat runs, in milliseconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        took = (time.perf_counter() - start) * 1000
+        best = took if best is None else min(best, took)
+    return best
+
+
+def bench_distance(args):
+    random.seed(args.seed)
+    lat, long = 39.74, -104.99
+    for n in args.sizes:
+        lats = [lat + random.uniform(-1, 1) for _ in range(n)]
+        longs = [long + random.uniform(-1, 1) for _ in range(n)]
+
+        def scalar():
+            dists = [app.get_distance(lat, long, a, b) for a, b in zip(lats, longs)]
+            sorted(range(n), key=dists.__getitem__)[:args.k]
+
+        def batched():
+            app.nearest(lat, long, lats, longs, k=args.k)
+
+        s = timed(scalar, args.repeat)
+        b = timed(batched, args.repeat)
+        print("n=%-8d scalar %9.3f ms   batch %9.3f ms   x%.1f" % (n, s, b, s / b))
+    print("numpy:", "yes" if app.np is not None else "no (pure python fallback)")
+
+
+def synthetic_rows(n, seed):
+    # shaped like what DictCursor returns for PUBLIC_EVENTS_Q
+    rng = random.Random(seed)
+    now = datetime.datetime.now().replace(microsecond=0)
+    rows = []
+    for i in range(n):
+        lat = 39.74 + rng.uniform(-0.5, 0.5)
+        long = -104.99 + rng.uniform(-0.5, 0.5)
+        rows.append({
+            "UEID": i + 1, "eventHost": rng.randint(1, 500), "eventName": "event%d" % (i + 1),
+            "date": now + datetime.timedelta(hours=rng.randint(1, 24 * 90)),
+            "address": "%d %s" % (rng.randint(1, 9999), rng.choice(STREETS)),
+            "lat": decimal.Decimal("%.3f" % lat), "long": decimal.Decimal("%.3f" % long),
+            "description": "synthetic event", "tags": ",".join(rng.sample(TAGS, rng.randint(1, 3))),
+            "cap": rng.choice([0, 10, 25, 100]), "latHash": app.hashC(lat), "longHash": app.hashC(long),
+            "isPrivate": 0, "hostName": "group%d" % rng.randint(1, 500),
+        })
+    return rows
+
+
+def traced(build):
+    # bytes still allocated by what build() returns
+    tracemalloc.start()
+    try:
+        kept = build()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return kept, size
+
+
+def bench_memory(args):
+    # DictCursor rows vs EventRecords: resident size and serializing a feed
+    for n in args.sizes:
+        rows, row_bytes = traced(lambda: synthetic_rows(n, args.seed))
+        records, record_bytes = traced(lambda: [app.EventRecord(row) for row in synthetic_rows(n, args.seed)])
+        feed = {"groupEvents": [], "eventFeed": rows}
+        compact = {"groupEvents": [], "eventFeed": records}
+        d = timed(lambda: app.dumps(feed), args.repeat)
+        r = timed(lambda: app.encode_json(compact), args.repeat)
+        print("n=%-8d dict %8.1f KiB (%4d B/event)   record %8.1f KiB (%4d B/event)   dumps %8.2f ms   encode %8.2f ms" % (
+            n, row_bytes / 1024, row_bytes // n, record_bytes / 1024, record_bytes // n, d, r))
+
+
+def bench_snapshots(args):
+    # public part of the feed for many users in one hot cell: walking the
+    # grid per request vs sorting the cell's shared snapshot
+    rng = random.Random(args.seed)
+    for n in args.sizes:
+        grid = app.EventGrid()
+        grid.reload(lambda: [app.EventRecord(row) for row in synthetic_rows(n, args.seed)])
+        snapshots = app.CellSnapshots(grid)
+        points = [(39.74 + rng.uniform(0, 0.099), -104.95 + rng.uniform(0, 0.099)) for _ in range(args.users)]
+        g = timed(lambda: [grid.query(lat, long, args.radius) for lat, long in points], args.repeat)
+        build = timed(lambda: snapshots.query(points[0][0], points[0][1], args.radius), 1)
+        s = timed(lambda: [snapshots.query(lat, long, args.radius) for lat, long in points], args.repeat)
+        print("n=%-8d grid %9.3f ms   snapshot %9.3f ms   x%.1f   (%d users, build %.3f ms)" % (
+            n, g, s, g / s, args.users, build))
+
+
+def bench_json(args):
+    # feed-sized payloads through each JSON backend, then compressed
+    backends = [("stdlib", app.stdlib_dumps)]
+    if app.orjson is not None:
+        backends.append(("orjson", app.orjson_dumps))
+    for n in args.sizes:
+        rows = synthetic_rows(n, args.seed)
+        feed = {"groupEvents": rows[:n // 10], "eventFeed": rows[n // 10:]}
+        records = [app.EventRecord(row) for row in rows]
+        compact = {"groupEvents": records[:n // 10], "eventFeed": records[n // 10:]}
+        print("n=%d" % n)
+        for name, dumps in backends:
+            print("  %-18s %9.2f ms" % (name + " rows", timed(lambda: dumps(feed), args.repeat)))
+        # plain rows the way non-feed routes (getUserEvents and friends)
+        # send them, through the app's JSON provider
+        print("  %-18s %9.2f ms" % ("rows (provider)", timed(lambda: app.encode_json(feed), args.repeat)))
+        print("  %-18s %9.2f ms" % ("records (" + ("orjson" if app.dumps is app.orjson_dumps else "stdlib") + ")",
+                                     timed(lambda: app.encode_json(compact), args.repeat)))
+
+        data = app.encode_json(compact).encode()
+        codecs = [("gzip", lambda: gzip.compress(data, compresslevel=app.GZIP_LEVEL))]
+        if app.brotli is not None:
+            codecs.append(("br", lambda: app.brotli.compress(data, quality=app.BROTLI_QUALITY)))
+        for name, compress in codecs:
+            took = timed(compress, args.repeat)
+            print("  %-18s %9.2f ms   %d -> %d bytes (%.1f%%)" % (
+                name, took, len(data), len(compress()), len(compress()) / len(data) * 100))
+
+
+def bench_signup(args):
+    # many users racing for the same event against a running server, the
+    # event must never end up with more signups than its cap
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+    users = range(args.first_user, args.first_user + args.users)
+
+    def sign_up(uuid):
+        start = time.perf_counter()
+        r = session.get(args.url + "/signUp", params={"UEID": args.event, "UUID": uuid})
+        return r.status_code, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(sign_up, users))
+    took = time.perf_counter() - start
+
+    statuses = collections.Counter(status for status, _ in results)
+    event = session.get(args.url + "/getSingleEvent", params={"UEID": args.event}).json()["event"]
+    print("%d signups in %.2fs (%.0f req/s) with %d clients" % (len(results), took, len(results) / took, args.concurrency))
+    print("status codes:", dict(statuses))
+    print("cap %s, signUps %s" % (event["cap"], event["signUps"]))
+    if event["cap"] and event["signUps"] > event["cap"]:
+        raise SystemExit("event is oversubscribed")
+
+
+def sql_statements(text):
+    # split a .sql file on ; (or whatever DELIMITER switches it to) so the
+    # procedure bodies go over as one statement each
+    delimiter = ";"
+    statement = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.upper().startswith("DELIMITER "):
+            delimiter = stripped.split(None, 1)[1]
+            continue
+        if not statement and (not stripped or stripped.startswith("--")):
+            continue
+        statement.append(line)
+        if stripped.endswith(delimiter):
+            statement[-1] = line.rstrip()[:-len(delimiter)]
+            yield "\n".join(statement).strip()
+            statement = []
+    if "".join(statement).strip():
+        yield "\n".join(statement).strip()
+
+
+def apply_schema(cursor):
+    # the base schema, then the numbered migrations in order
+    files = [os.path.join(SQL_DIR, "schema.sql")]
+    files += sorted(glob.glob(os.path.join(SQL_DIR, "[0-9]*.sql")))
+    for path in files:
+        with open(path) as f:
+            for statement in sql_statements(f.read()):
+                cursor.execute(statement)
+        print("applied", os.path.basename(path))
+
+
+def bench_seed(args):
+    # a reproducible dataset in the configured db_* database
+    rng = random.Random(args.seed)
+    conn = app._open_connection()
+    cursor = conn.cursor()
+    try:
+        if args.reset:
+            for table in ("signedUpArchive", "eventsArchive", "signUpCounts", "signedUp", "events", "prefs", "userGroups", "users"):
+                cursor.execute("DROP TABLE IF EXISTS " + table)
+        apply_schema(cursor)
+
+        # users first, then groups, so UUIDs are predictable: users are
+        # 1..users and groups follow
+        accounts = []
+        for i in range(args.users):
+            accounts.append((i + 1, "user%d" % (i + 1), "password", False, "1"))
+        for i in range(args.groups):
+            accounts.append((args.users + i + 1, "group%d" % (i + 1), "password", rng.random() < args.private, "0"))
+        cursor.executemany(
+            "INSERT INTO users (UUID, userName, password, isPrivate, accountType) VALUES (%s, %s, %s, %s, %s)",
+            accounts)
+
+        groups = range(args.users + 1, args.users + args.groups + 1)
+        members = set()
+        for uuid in range(1, args.users + 1):
+            for group in rng.sample(groups, min(args.memberships, len(groups))):
+                members.add((group, uuid, rng.random() < 0.1))
+        cursor.executemany("INSERT INTO userGroups (groupID, userID, pending) VALUES (%s, %s, %s)", sorted(members))
+
+        prefs = []
+        for uuid in range(1, args.users + args.groups + 1):
+            prefs.append((uuid, ",".join(rng.sample(TAGS, rng.randint(0, 4))), rng.choice([None, 5, 10, 25, 50])))
+        cursor.executemany("INSERT INTO prefs (UUID, prefs, dist) VALUES (%s, %s, %s)", prefs)
+
+        now = datetime.datetime.now().replace(microsecond=0)
+        events = []
+        for i in range(args.events):
+            lat = args.lat + rng.uniform(-args.spread, args.spread)
+            long = args.long + rng.uniform(-args.spread, args.spread)
+            date = now + datetime.timedelta(hours=rng.randint(-24 * 30, 24 * 90))
+            events.append((
+                i + 1, rng.choice(groups), "event%d" % (i + 1), date,
+                "%d %s" % (rng.randint(1, 9999), rng.choice(STREETS)),
+                round(lat, 3), round(long, 3), "synthetic event",
+                ",".join(rng.sample(TAGS, rng.randint(1, 3))),
+                rng.choice([0, 10, 25, 100, 500]),
+                app.hashC(lat), app.hashC(long), rng.random() < args.private,
+            ))
+        for start in range(0, len(events), 1000):
+            cursor.executemany(
+                "INSERT INTO events (UEID, eventHost, eventName, date, address, lat, `long`, description, tags, cap, latHash, longHash, isPrivate)"
+                " VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                events[start:start + 1000])
+
+        signups = set()
+        for uuid in range(1, args.users + 1):
+            for ueid in rng.sample(range(1, args.events + 1), min(args.signups, args.events)):
+                signups.add((uuid, ueid))
+        cursor.executemany("INSERT INTO signedUp (UUID, UEID) VALUES (%s, %s)", sorted(signups))
+        cursor.execute("DELETE FROM signUpCounts")
+        cursor.execute(
+            "INSERT INTO signUpCounts (UEID, signUps)"
+            " SELECT e.UEID, COUNT(s.UEID) FROM events e LEFT JOIN signedUp s ON s.UEID = e.UEID GROUP BY e.UEID")
+        conn.commit()
+        print("seeded %d users, %d groups, %d memberships, %d events, %d signups" % (
+            args.users, args.groups, len(members), args.events, len(signups)))
+    finally:
+        cursor.close()
+        conn.close()
+
+
+class FakeGeocoder(BaseHTTPRequestHandler):
+    # answers like the geocoding API with a stable point per address near
+    # the seeded area, after an optional artificial delay
+    center = (39.74, -104.99)
+    spread = 0.5
+    delay = 0.0
+
+    def do_GET(self):
+        address = parse_qs(urlparse(self.path).query).get("address", [""])[0]
+        digest = hashlib.sha1(address.encode()).digest()
+        lat = self.center[0] + (digest[0] / 255 * 2 - 1) * self.spread
+        lng = self.center[1] + (digest[1] / 255 * 2 - 1) * self.spread
+        if self.delay:
+            time.sleep(self.delay)
+        body = json.dumps({"status": "OK", "results": [{"geometry": {"location": {"lat": lat, "lng": lng}}}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_geocoder(port, lat, long, spread, delay):
+    FakeGeocoder.center = (lat, long)
+    FakeGeocoder.spread = spread
+    FakeGeocoder.delay = delay
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeGeocoder)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d/" % server.server_address[1]
+
+
+def bench_geocoder(args):
+    server, url = start_fake_geocoder(args.port, args.lat, args.long, args.spread, args.delay)
+    print("fake geocoder on", url, "- set geo_coding_url to it")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+class RespStandIn(socketserver.StreamRequestHandler):
+    # just enough of a Redis server for the cache backend: PING, AUTH,
+    # SELECT, GET, SET (with EX/PX), DEL, PUBLISH and SUBSCRIBE, all in one
+    # keyspace and without persistence
+    values = {}
+    channels = collections.defaultdict(set)
+    lock = threading.Lock()
+
+    @staticmethod
+    def bulk(value):
+        if value is None:
+            return b"$-1\r\n"
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def send(self, data):
+        with self.write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def handle(self):
+        self.write_lock = threading.Lock()
+        try:
+            while True:
+                try:
+                    args = app.RespBackend.read_reply(self.rfile)
+                except ConnectionError:
+                    return
+                command = args[0].upper()
+                self.send(self.run(command, args[1:]))
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                for subs in self.channels.values():
+                    subs.discard(self)
+
+    def run(self, command, args):
+        now = time.monotonic()
+        if command in (b"PING", b"AUTH", b"SELECT"):
+            return b"+OK\r\n" if command != b"PING" else b"+PONG\r\n"
+        if command == b"GET":
+            with self.lock:
+                entry = self.values.get(args[0])
+            return self.bulk(entry[0] if entry and (entry[1] is None or entry[1] > now) else None)
+        if command == b"SET":
+            expires = None
+            if len(args) >= 4 and args[2].upper() in (b"EX", b"PX"):
+                expires = now + int(args[3]) / (1 if args[2].upper() == b"EX" else 1000)
+            with self.lock:
+                self.values[args[0]] = (args[1], expires)
+            return b"+OK\r\n"
+        if command == b"DEL":
+            with self.lock:
+                gone = sum(self.values.pop(key, None) is not None for key in args)
+            return b":%d\r\n" % gone
+        if command == b"PUBLISH":
+            with self.lock:
+                subs = list(self.channels.get(args[0], ()))
+            message = b"*3\r\n" + self.bulk(b"message") + self.bulk(args[0]) + self.bulk(args[1])
+            for sub in subs:
+                try:
+                    sub.send(message)
+                except OSError:
+                    pass
+            return b":%d\r\n" % len(subs)
+        if command == b"SUBSCRIBE":
+            replies = []
+            with self.lock:
+                for n, channel in enumerate(args, 1):
+                    self.channels[channel].add(self)
+                    replies.append(b"*3\r\n" + self.bulk(b"subscribe") + self.bulk(channel) + b":%d\r\n" % n)
+            return b"".join(replies)
+        return b"-ERR unknown command '%s'\r\n" % command
+
+
+def start_resp_stand_in(port):
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", port), RespStandIn)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "redis://127.0.0.1:%d/0" % server.server_address[1]
+
+
+def bench_resp_server(args):
+    server, url = start_resp_stand_in(args.port)
+    print("stand-in Redis on", url, "- set cache_url to it")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def bench_invalidation(args):
+    # two Clusters standing in for two app processes: how long a broadcast
+    # takes to be replayed on the peer, and that a shared invalidation
+    # really drops the peer's cached feed
+    if args.url:
+        url = args.url
+    else:
+        server, url = start_resp_stand_in(0)
+    peers = []
+    for _ in range(2):
+        feeds = app.FeedCache(max_size=1000, ttl=60)
+        cluster = app.Cluster(app.RespBackend.from_url(url), channel="bench:invalidate")
+        cluster.share("feed", feeds, "invalidate_users")
+        peers.append((cluster, feeds))
+    (sender, feeds_a), (receiver, feeds_b) = peers
+
+    arrived = queue.Queue()
+    receiver.register("bench.ping", lambda sent: arrived.put(time.perf_counter() - sent))
+    for cluster, _ in peers:
+        cluster.start()
+    time.sleep(0.2)
+
+    key = app.FeedCache.key(1, args.lat, args.long)
+    feeds_b.put(key, [], ([], []), [])
+    feeds_a.invalidate_users([1])
+    deadline = time.monotonic() + 2
+    while feeds_b.get(key) is not None and time.monotonic() < deadline:
+        time.sleep(0.001)
+    print("peer feed invalidated:", feeds_b.get(key) is None)
+
+    samples = []
+    for _ in range(args.messages):
+        sender.send("bench.ping", time.perf_counter())
+        try:
+            samples.append(arrived.get(timeout=2) * 1000)
+        except queue.Empty:
+            break
+    samples.sort()
+    print("%d/%d broadcasts replayed  p50 %.3f ms  p99 %.3f ms  max %.3f ms" % (
+        len(samples), args.messages, percentile(samples, 50), percentile(samples, 99),
+        samples[-1] if samples else 0.0))
+    print("sender", sender.stats())
+    print("receiver", receiver.stats())
+
+
+def percentile(samples, p):
+    # samples must be sorted
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+
+def scenario_requests(args, rng):
+    # one request per call as (method, path, params, json)
+    users = range(1, args.users + 1)
+    groups = range(args.users + 1, args.users + args.groups + 1)
+    events = range(1, args.events + 1)
+    now = datetime.datetime.now().replace(microsecond=0)
+
+    def feed():
+        lat = args.lat + rng.uniform(-args.spread, args.spread)
+        long = args.long + rng.uniform(-args.spread, args.spread)
+        params = {"UUID": rng.choice(users), "lat": round(lat, 4), "long": round(long, 4)}
+        if args.limit:
+            params["limit"] = args.limit
+        return "GET", "/getEventFeed", params, None
+
+    def sign_up():
+        return "GET", "/signUp", {"UEID": rng.choice(events), "UUID": rng.choice(users)}, None
+
+    def create_event():
+        date = now + datetime.timedelta(hours=rng.randint(1, 24 * 90))
+        return "POST", "/createEvent", None, {
+            "UUID": rng.choice(groups),
+            "eventName": "load event",
+            "date": date.strftime("%Y-%m-%d %H:%M:%S"),
+            "address": "%d %s" % (rng.randint(1, 99999), rng.choice(STREETS)),
+            "desc": "created by bench.py load",
+            "tags": ",".join(rng.sample(TAGS, rng.randint(1, 3))),
+            "cap": rng.choice([0, 10, 50]),
+            "isPrivate": rng.random() < args.private,
+        }
+
+    def user_events():
+        params = {"UUID": rng.choice(users)}
+        if args.limit:
+            params["limit"] = args.limit
+        return "GET", "/getUserEvents", params, None
+
+    return {"feed": feed, "signUp": sign_up, "createEvent": create_event, "userEvents": user_events}
+
+
+def drive(session, url, make, total, concurrency):
+    # total requests from concurrency workers, returns sorted latencies in
+    # ms, the status counts and the wall time
+    latencies = []
+    statuses = collections.Counter()
+    lock = threading.Lock()
+    remaining = [total]
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+                method, path, params, body = make()
+            start = time.perf_counter()
+            try:
+                status = session.request(method, url + path, params=params, json=body).status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            took = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(took)
+                statuses[status] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return latencies, statuses, wall
+
+
+def bench_load(args):
+    # drives the routes against the seeded database, either through an
+    # in-process server (the default) or a running one with --url
+    geocoder = None
+    server = None
+    scratch = None
+    url = args.url
+    if url is None:
+        geocoder, geocoder_url = start_fake_geocoder(0, args.lat, args.long, args.spread, args.geocoder_delay)
+        app.geocoder.url = geocoder_url
+        # fake coordinates go to a throwaway cache, never the real one
+        # in the instance folder or the shared backend
+        scratch = tempfile.TemporaryDirectory()
+        app.geocoder.cache = app.GeocodeCache(os.path.join(scratch.name, "geocode_cache.sqlite"))
+        app.geocoder.shared = None
+        server = make_server("127.0.0.1", 0, app.create_app(), threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:%d" % server.server_port
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+    scenarios = scenario_requests(args, random.Random(args.seed))
+
+    try:
+        if args.warmup:
+            drive(session, url, scenarios["feed"], args.warmup, args.concurrency)
+        print("%-12s %8s %9s %9s %9s %9s %9s  %s" % ("route", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "max ms", "statuses"))
+        for name in args.scenarios:
+            latencies, statuses, wall = drive(session, url, scenarios[name], args.requests, args.concurrency)
+            print("%-12s %8d %9.1f %9.2f %9.2f %9.2f %9.2f  %s" % (
+                name, len(latencies), len(latencies) / wall,
+                percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99),
+                latencies[-1] if latencies else 0.0, dict(statuses)))
+    finally:
+        if server is not None:
+            server.shutdown()
+        if geocoder is not None:
+            geocoder.shutdown()
+        if scratch is not None:
+            scratch.cleanup()
+
+
+def add_dataset_args(p):
+    # seed and load have to agree on these to pick valid ids
+    p.add_argument("--users", type=int, default=2000)
+    p.add_argument("--groups", type=int, default=200)
+    p.add_argument("--events", type=int, default=20000)
+    p.add_argument("--private", type=float, default=0.2, help="share of private groups and events")
+    p.add_argument("--lat", type=float, default=39.74)
+    p.add_argument("--long", type=float, default=-104.99)
+    p.add_argument("--spread", type=float, default=0.5, help="degrees around --lat/--long")
+    p.add_argument("--seed", type=int, default=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the events backend")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("distance", help="scalar get_distance vs batch nearest()")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    p.add_argument("-k", type=int, default=50)
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(run=bench_distance)
+
+    p = sub.add_parser("memory", help="DictCursor rows vs EventRecord size and feed serialization")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(run=bench_memory)
+
+    p = sub.add_parser("snapshots", help="grid query vs shared cell snapshot for users in one cell")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--radius", type=float, default=25)
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(run=bench_snapshots)
+
+    p = sub.add_parser("json", help="stdlib vs orjson and gzip/br on feed-sized payloads")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(run=bench_json)
+
+    p = sub.add_parser("signup", help="concurrent /signUp rush on one event")
+    p.add_argument("--url", default="http://127.0.0.1:5000")
+    p.add_argument("--event", type=int, required=True, help="UEID to sign up for")
+    p.add_argument("--first-user", type=int, default=1)
+    p.add_argument("--users", type=int, default=500)
+    p.add_argument("--concurrency", type=int, default=100)
+    p.set_defaults(run=bench_signup)
+
+    p = sub.add_parser("seed", help="create the schema and fill it with synthetic data")
+    add_dataset_args(p)
+    p.add_argument("--memberships", type=int, default=3, help="groups per user")
+    p.add_argument("--signups", type=int, default=5, help="events per user")
+    p.add_argument("--reset", action="store_true", help="drop the tables first")
+    p.set_defaults(run=bench_seed)
+
+    p = sub.add_parser("geocoder", help="run the fake geocoder on its own")
+    p.add_argument("--port", type=int, default=8099)
+    p.add_argument("--lat", type=float, default=39.74)
+    p.add_argument("--long", type=float, default=-104.99)
+    p.add_argument("--spread", type=float, default=0.5)
+    p.add_argument("--delay", type=float, default=0.0, help="seconds per lookup")
+    p.set_defaults(run=bench_geocoder)
+
+    p = sub.add_parser("load", help="throughput and p50/p95/p99 per route on a seeded database")
+    add_dataset_args(p)
+    p.add_argument("--url", help="running server to hit instead of an in-process one")
+    p.add_argument("--scenarios", nargs="+", default=["feed", "userEvents", "signUp", "createEvent"],
+                   choices=["feed", "userEvents", "signUp", "createEvent"])
+    p.add_argument("--requests", type=int, default=2000, help="per scenario")
+    p.add_argument("--concurrency", type=int, default=32)
+    p.add_argument("--warmup", type=int, default=200, help="feed requests before measuring")
+    p.add_argument("--limit", type=int, help="page size for feed and userEvents")
+    p.add_argument("--geocoder-delay", type=float, default=0.05, help="seconds per fake lookup")
+    p.set_defaults(run=bench_load)
+
+    p = sub.add_parser("resp-server", help="run the stand-in Redis server on its own")
+    p.add_argument("--port", type=int, default=6379)
+    p.set_defaults(run=bench_resp_server)
+
+    p = sub.add_parser("invalidation", help="cross-process invalidation latency over the cache backend")
+    p.add_argument("--url", help="redis:// server to use instead of the stand-in")
+    p.add_argument("--messages", type=int, default=1000)
+    p.add_argument("--lat", type=float, default=39.74)
+    p.add_argument("--long", type=float, default=-104.99)
+    p.set_defaults(run=bench_invalidation)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+-- Per-event attendee counter, kept in step with signedUp by the signUp,
+-- unSignUpEvent, createEvent and deleteEvent routes so reads no longer
+-- need COUNT(*) over signedUp.
+CREATE TABLE IF NOT EXISTS signUpCounts (
+    UEID INT NOT NULL PRIMARY KEY,
+    signUps INT NOT NULL DEFAULT 0
+);
+
+INSERT INTO signUpCounts (UEID, signUps)
+SELECT e.UEID, COUNT(s.UEID)
+FROM events e
+LEFT JOIN signedUp s ON s.UEID = e.UEID
+GROUP BY e.UEID
+ON DUPLICATE KEY UPDATE signUps = VALUES(signUps);
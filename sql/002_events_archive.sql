@@ -0,0 +1,5 @@
+-- Past events and their signups, moved out of the live tables in chunks by
+-- the archiver (archive_enabled=1) so the upcoming-event queries stay small.
+CREATE TABLE IF NOT EXISTS eventsArchive LIKE events;
+
+CREATE TABLE IF NOT EXISTS signedUpArchive LIKE signedUp;
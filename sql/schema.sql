@@ -0,0 +1,104 @@
+-- Base schema and stored procedures the app expects, for seeding a local
+-- MySQL to benchmark against (see bench.py seed). Numbered migrations in
+-- this folder are applied on top of it in order.
+
+CREATE TABLE IF NOT EXISTS users (
+    UUID INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    userName VARCHAR(64) NOT NULL UNIQUE,
+    password VARCHAR(128) NOT NULL,
+    isPrivate BOOLEAN NOT NULL DEFAULT TRUE,
+    accountType CHAR(1) NOT NULL,
+    parentAccount INT NULL,
+    KEY usersParent (parentAccount)
+);
+
+CREATE TABLE IF NOT EXISTS userGroups (
+    groupID INT NOT NULL,
+    userID INT NOT NULL,
+    pending BOOLEAN NOT NULL DEFAULT TRUE,
+    PRIMARY KEY (userID, groupID),
+    KEY userGroupsGroup (groupID)
+);
+
+CREATE TABLE IF NOT EXISTS events (
+    UEID INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    eventHost INT NOT NULL,
+    eventName VARCHAR(128) NOT NULL,
+    date DATETIME NOT NULL,
+    address VARCHAR(255) NOT NULL,
+    lat DECIMAL(8, 3) NULL,
+    `long` DECIMAL(8, 3) NULL,
+    description TEXT,
+    tags VARCHAR(255),
+    cap INT NOT NULL DEFAULT 0,
+    latHash INT NULL,
+    longHash INT NULL,
+    isPrivate BOOLEAN NOT NULL DEFAULT FALSE,
+    KEY eventsHost (eventHost, date),
+    KEY eventsCell (latHash, longHash, date),
+    KEY eventsDate (date)
+);
+
+CREATE TABLE IF NOT EXISTS signedUp (
+    UUID INT NOT NULL,
+    UEID INT NOT NULL,
+    PRIMARY KEY (UUID, UEID),
+    KEY signedUpEvent (UEID)
+);
+
+CREATE TABLE IF NOT EXISTS prefs (
+    UUID INT NOT NULL PRIMARY KEY,
+    prefs VARCHAR(255) NOT NULL DEFAULT '',
+    dist INT NULL
+);
+
+DROP PROCEDURE IF EXISTS createAccount;
+DELIMITER //
+CREATE PROCEDURE createAccount(IN name VARCHAR(64), IN pass VARCHAR(128), IN private BOOLEAN, IN kind CHAR(1))
+BEGIN
+    INSERT INTO users (userName, password, isPrivate, accountType) VALUES (name, pass, private, kind);
+    INSERT INTO prefs (UUID, prefs, dist) VALUES (LAST_INSERT_ID(), '', NULL);
+END //
+DELIMITER ;
+
+DROP PROCEDURE IF EXISTS addUserToGroup;
+DELIMITER //
+CREATE PROCEDURE addUserToGroup(IN user INT, IN grp INT)
+BEGIN
+    INSERT INTO userGroups (groupID, userID, pending) VALUES (grp, user, FALSE)
+    ON DUPLICATE KEY UPDATE pending = FALSE;
+END //
+DELIMITER ;
+
+DROP PROCEDURE IF EXISTS updatePreferences;
+DELIMITER //
+CREATE PROCEDURE updatePreferences(IN user INT, IN newPrefs VARCHAR(255))
+BEGIN
+    INSERT INTO prefs (UUID, prefs) VALUES (user, newPrefs)
+    ON DUPLICATE KEY UPDATE prefs = newPrefs;
+END //
+DELIMITER ;
+
+DROP PROCEDURE IF EXISTS updateDistance;
+DELIMITER //
+CREATE PROCEDURE updateDistance(IN user INT, IN newDist INT)
+BEGIN
+    INSERT INTO prefs (UUID, dist) VALUES (user, newDist)
+    ON DUPLICATE KEY UPDATE dist = newDist;
+END //
+DELIMITER ;
+
+-- public events in the caller's hashC cell and the ones around it
+DROP PROCEDURE IF EXISTS findEvents;
+DELIMITER //
+CREATE PROCEDURE findEvents(IN user INT, IN latCell INT, IN longCell INT)
+BEGIN
+    SELECT e.*, u.userName AS hostName
+    FROM events e
+    JOIN users u ON e.eventHost = u.UUID
+    WHERE e.isPrivate = FALSE
+    AND e.latHash BETWEEN latCell - 1 AND latCell + 1
+    AND e.longHash BETWEEN longCell - 1 AND longCell + 1
+    AND e.date >= NOW();
+END //
+DELIMITER ;